@@ -5,10 +5,11 @@ Reads sectors array on articles and aggregates sector sentiment safely.
 
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Any, List
-from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import firebase_admin
 from firebase_admin import firestore
 
@@ -22,64 +23,102 @@ except ValueError:
 db = firestore.client()
 
 SECTORS = ["IT","Banking","Pharma","Auto","FMCG","Energy","Metals","Real Estate","Telecom","Power"]
+SECTOR_INDEX = {s: i for i, s in enumerate(SECTORS)}
+SENTIMENT_SCORES = {
+    "Positive": 1, "Negative": -1, "Neutral": 0,
+    "positive": 1, "negative": -1, "neutral": 0,
+}
 
 
 class DailyAnalytics:
     def __init__(self):
-        self.batch_size = 1000
-
-    def _sentiment_to_score(self, s: str) -> int:
-        s = (s or '').lower()
-        if s == 'positive':
-            return 1
-        if s == 'negative':
-            return -1
-        return 0
-
-    def _process_batch(self, docs: List[Any], overall: List[int], sectors: Dict[str, List[int]]):
+        self.shards = 24  # hourly sub-ranges for the fallback scan
+        self.max_workers = 12
+
+    def _process_batch(self, docs: Iterable[Any]) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        """Fold a stream of articles into (count, score_sum, sector_sum, sector_count)."""
+        count = score_sum = 0
+        cols: List[int] = []
+        tag_scores: List[int] = []
         for d in docs:
             data = d.to_dict()
-            score = self._sentiment_to_score(data.get('sentiment', 'Neutral'))
-            overall.append(score)
+            score = SENTIMENT_SCORES.get(data.get('sentiment'), 0)
+            count += 1
+            score_sum += score
             for s in (data.get('sectors') or []):
-                if s in SECTORS:
-                    sectors[s].append(score)
+                j = SECTOR_INDEX.get(s)
+                if j is not None:
+                    cols.append(j)
+                    tag_scores.append(score)
+        idx = np.asarray(cols, dtype=np.intp)
+        sector_sum = np.bincount(idx, weights=tag_scores, minlength=len(SECTORS)).astype(np.int64)
+        sector_count = np.bincount(idx, minlength=len(SECTORS))
+        return count, score_sum, sector_sum, sector_count
+
+    def _fetch_shard(self, start: datetime, end: datetime) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        # The gRPC stream pages internally, so no client-side cursor loop is needed
+        q = (db.collection('articles')
+                .where('publishedAt', '>=', start)
+                .where('publishedAt', '<', end)
+                .select(['sentiment', 'sectors']))
+        return self._process_batch(q.stream())
+
+    def _aggregate_server_side(self, start: datetime, end: datetime) -> Tuple[int, float, np.ndarray, np.ndarray]:
+        """count + avg(sentimentScore) for the day and for each sector, computed by Firestore.
+
+        avg() skips articles saved before sentimentScore existed, so they count
+        towards articlesAnalyzed but don't pull the mean towards 0. Sums are
+        returned as avg * count so callers divide back to the mean.
+        Needs a composite index on (sectors array-contains, publishedAt).
+        """
+        base = (db.collection('articles')
+                  .where('publishedAt', '>=', start)
+                  .where('publishedAt', '<', end))
+        queries = [base] + [base.where('sectors', 'array_contains', s) for s in SECTORS]
+
+        def run(q) -> Tuple[int, float]:
+            res = {r.alias: r.value for r in q.count(alias='n').avg('sentimentScore', alias='mean').get()[0]}
+            n = int(res.get('n') or 0)
+            return n, float(res.get('mean') or 0.0) * n
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            (total, score_sum), *per_sector = pool.map(run, queries)
+        sector_count = np.array([n for n, _ in per_sector], dtype=np.int64)
+        sector_sum = np.array([t for _, t in per_sector], dtype=np.float64)
+        return total, score_sum, sector_sum, sector_count
+
+    def _scan(self, start: datetime, end: datetime) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        step = (end - start) / self.shards
+        bounds = [(start + i * step, start + (i + 1) * step) for i in range(self.shards)]
+
+        total = score_sum = 0
+        sector_sum = np.zeros(len(SECTORS), dtype=np.int64)
+        sector_count = np.zeros(len(SECTORS), dtype=np.int64)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for n, ssum, sec_sum, sec_count in pool.map(lambda b: self._fetch_shard(*b), bounds):
+                total += n
+                score_sum += ssum
+                sector_sum += sec_sum
+                sector_count += sec_count
+        return total, score_sum, sector_sum, sector_count
 
     def calculate(self, date_str: str = None) -> Dict[str, Any]:
         if date_str:
-            day = datetime.strptime(date_str, "%Y-%m-%d")
+            day = datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
         else:
-            day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
         start = day
         end = start + timedelta(days=1)
 
-        overall_scores: List[int] = []
-        sector_scores: Dict[str, List[int]] = defaultdict(list)
-        total = 0
+        try:
+            total, score_sum, sector_sum, sector_count = self._aggregate_server_side(start, end)
+        except Exception as e:
+            logger.warning("Aggregation query failed, falling back to scan: %s", e)
+            total, score_sum, sector_sum, sector_count = self._scan(start, end)
 
-        ref = db.collection('articles')
-        q = (ref.where('publishedAt', '>=', start)
-                .where('publishedAt', '<', end)
-                .order_by('publishedAt')
-                .limit(self.batch_size))
-
-        last = None
-        while True:
-            cur_q = q.start_after(last) if last else q
-            docs = list(cur_q.stream())
-            if not docs:
-                break
-            self._process_batch(docs, overall_scores, sector_scores)
-            total += len(docs)
-            last = docs[-1]
-            if len(docs) < self.batch_size:
-                break
-
-        overall = (sum(overall_scores) / len(overall_scores)) if overall_scores else 0.0
-        breakdown = {}
-        for s in SECTORS:
-            vals = sector_scores.get(s, [])
-            breakdown[s] = round(sum(vals)/len(vals), 3) if vals else 0.0
+        overall = score_sum / total if total else 0.0
+        means = sector_sum / np.maximum(sector_count, 1)
+        breakdown = {s: round(float(means[j]), 3) for j, s in enumerate(SECTORS)}
 
         result = {
             "date": day.strftime("%Y-%m-%d"),
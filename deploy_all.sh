@@ -50,6 +50,8 @@ gcloud functions deploy market-data-api \
   --timeout=30s --memory=512MB --max-instances=100 \
   --vpc-connector=redis-connector \
   --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID,REDIS_HOST=$REDIS_HOST,REDIS_PORT=$REDIS_PORT"
+# Background cache refresh runs after the response; keep CPU allocated for it
+gcloud run services update market-data-api --region="$REGION" --no-cpu-throttling
 popd >/dev/null
 
 echo "== Deploy Phase 1: Pipeline =="
@@ -58,7 +60,8 @@ gcloud functions deploy news-pipeline \
   --gen2 --runtime=python312 --region="$REGION" \
   --source=. --entry-point=main --trigger-http --allow-unauthenticated \
   --timeout=540s --memory=1GB --max-instances=1 --concurrency=1 \
-  --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID"
+  --vpc-connector=redis-connector \
+  --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID,REDIS_HOST=$REDIS_HOST,REDIS_PORT=$REDIS_PORT"
 popd >/dev/null
 
 echo "== Scheduler for Phase 1 =="
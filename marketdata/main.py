@@ -4,15 +4,18 @@ Redis (Memorystore) cache with 5m TTL, Firebase App Check verification,
 Secret Manager for API key, and stale-while-revalidate fallback.
 """
 
-import json
 import logging
 import os
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import requests
+import httpx
+import orjson
 import redis
 import firebase_admin
 from firebase_admin import app_check
@@ -36,20 +39,39 @@ secret_client = secretmanager.SecretManagerServiceClient()
 REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 CACHE_KEY = "market_data"
-CACHE_TTL = 300  # seconds
+FRESH_KEY = "market_data:fresh_until"
+LOCK_KEY = "market_data:refreshing"
+CACHE_TTL = 300  # seconds before a background refresh is triggered
+STALE_TTL = 3600  # seconds stale data may still be served
+LOCK_TTL = 30  # seconds; bounds a crashed refresher
+API_KEY_TTL = 3600  # re-fetch hourly so rotated secrets are picked up
+_api_key_cache: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
+
+# HTTP/2 client shared across requests: concurrent quote fetches are
+# multiplexed over one keep-alive TLS connection to Alpha Vantage
+http = httpx.Client(http2=True, timeout=10, limits=httpx.Limits(max_keepalive_connections=8))
+
+INDEX_SYMBOLS: List[Tuple[str, str]] = [("NIFTY 50", "^NSEI"), ("SENSEX", "^BSESN")]
+
+# One pool per instance; connections are reused across requests. Failures
+# surface on the command itself rather than via a PING on every request.
+# Values are raw bytes fed straight to orjson, so responses are not decoded.
+_redis_pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, max_connections=32,
+                                   socket_timeout=5, socket_connect_timeout=5, retry_on_timeout=True,
+                                   health_check_interval=30)
+_redis = redis.Redis(connection_pool=_redis_pool)
 
 def redis_client() -> Optional[redis.Redis]:
-    try:
-        r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
-        r.ping()
-        return r
-    except Exception as e:
-        logger.error("Redis unavailable: %s", e)
-        return None
+    return _redis
 
 def get_api_key() -> str:
+    now = time.monotonic()
+    if _api_key_cache["value"] and now - _api_key_cache["fetched_at"] < API_KEY_TTL:
+        return _api_key_cache["value"]
     name = f"projects/{PROJECT_ID}/secrets/financial-api-key/versions/latest"
-    return secret_client.access_secret_version(request={"name": name}).payload.data.decode("utf-8")
+    key = secret_client.access_secret_version(request={"name": name}).payload.data.decode("utf-8")
+    _api_key_cache.update(value=key, fetched_at=now)
+    return key
 
 def verify_app_check_token() -> bool:
     token = request.headers.get('X-Firebase-AppCheck')
@@ -62,27 +84,22 @@ def verify_app_check_token() -> bool:
         logger.warning("App Check failed: %s", e)
         return False
 
-def fetch_indices(api_key: str) -> List[Dict[str, Any]]:
-    out = []
+def fetch_quote(api_key: str, name: str, symbol: str) -> Optional[Dict[str, Any]]:
     try:
-        u = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^NSEI&apikey={api_key}"
-        r = requests.get(u, timeout=10)
+        u = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={api_key}"
+        r = http.get(u)
         r.raise_for_status()
         q = r.json().get("Global Quote", {})
         if q.get("05. price"):
-            out.append({"name":"NIFTY 50","price": float(q.get("05. price",0)),"change": float(q.get("09. change",0)),"changePercent": float(str(q.get("10. change percent","0")).replace('%',''))})
+            return {"name":name,"price": float(q.get("05. price",0)),"change": float(q.get("09. change",0)),"changePercent": float(str(q.get("10. change percent","0")).replace('%',''))}
     except Exception as e:
-        logger.error("NIFTY fetch error: %s", e)
-    try:
-        u = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^BSESN&apikey={api_key}"
-        r = requests.get(u, timeout=10)
-        r.raise_for_status()
-        q = r.json().get("Global Quote", {})
-        if q.get("05. price"):
-            out.append({"name":"SENSEX","price": float(q.get("05. price",0)),"change": float(q.get("09. change",0)),"changePercent": float(str(q.get("10. change percent","0")).replace('%',''))})
-    except Exception as e:
-        logger.error("SENSEX fetch error: %s", e)
-    return out
+        logger.error("%s fetch error: %s", name, e)
+    return None
+
+def fetch_indices(api_key: str) -> List[Dict[str, Any]]:
+    with ThreadPoolExecutor(max_workers=len(INDEX_SYMBOLS)) as pool:
+        quotes = pool.map(lambda s: fetch_quote(api_key, *s), INDEX_SYMBOLS)
+        return [q for q in quotes if q]
 
 def fetch_movers(api_key: str) -> Dict[str, List[Dict[str, Any]]]:
     # Stubbed demo movers; replace with provider calls
@@ -104,65 +121,104 @@ def fetch_sectors(api_key: str) -> List[Dict[str, Any]]:
 def get_market_data_live() -> Optional[Dict[str, Any]]:
     try:
         key = get_api_key()
-        indices = fetch_indices(key)
-        movers = fetch_movers(key)
-        sectors = fetch_sectors(key)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            f_indices = pool.submit(fetch_indices, key)
+            f_movers = pool.submit(fetch_movers, key)
+            f_sectors = pool.submit(fetch_sectors, key)
+            indices, movers, sectors = f_indices.result(), f_movers.result(), f_sectors.result()
         return {
             "indices": indices,
             "gainers": movers.get('gainers', []),
             "losers": movers.get('losers', []),
             "sectors": sectors,
-            "lastUpdated": datetime.utcnow().isoformat()
+            "lastUpdated": datetime.now(timezone.utc).isoformat()
         }
     except Exception as e:
         logger.error("Fetch live error: %s", e)
         return None
 
-def get_cached(r: Optional[redis.Redis]) -> Optional[Dict[str, Any]]:
-    if not r: return None
+def get_cached(r: Optional[redis.Redis]) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """Return (data, is_fresh). Data outlives freshness by STALE_TTL."""
+    if not r: return None, False
     try:
-        v = r.get(CACHE_KEY)
-        return json.loads(v) if v else None
+        v, fresh = r.mget(CACHE_KEY, FRESH_KEY)
+        return (orjson.loads(v) if v else None), bool(fresh)
     except Exception as e:
         logger.error("Redis get error: %s", e)
-        return None
+        return None, False
 
 def set_cached(r: Optional[redis.Redis], data: Dict[str, Any]):
     if not r: return
     try:
-        r.setex(CACHE_KEY, CACHE_TTL, json.dumps(data))
+        pipe = r.pipeline()
+        pipe.setex(CACHE_KEY, STALE_TTL, orjson.dumps(data))
+        pipe.setex(FRESH_KEY, CACHE_TTL, 1)
+        pipe.execute()
     except Exception as e:
         logger.error("Redis set error: %s", e)
 
+def refresh_cache(r: Optional[redis.Redis]) -> Optional[Dict[str, Any]]:
+    live = get_market_data_live()
+    if live:
+        set_cached(r, live)
+    return live
+
+def refresh_in_background(r: redis.Redis):
+    # SET NX lock so concurrent instances don't stampede the upstream API
+    try:
+        if not r.set(LOCK_KEY, 1, nx=True, ex=LOCK_TTL):
+            return
+    except Exception as e:
+        logger.error("Redis lock error: %s", e)
+        return
+
+    def _run():
+        try:
+            refresh_cache(r)
+        finally:
+            try:
+                r.delete(LOCK_KEY)
+            except Exception as e:
+                logger.error("Redis unlock error: %s", e)
+
+    # Runs after the response is sent, so the service needs CPU always allocated
+    # (--no-cpu-throttling, see DEPLOYMENT.md) or gen2 throttles it to a crawl
+    threading.Thread(target=_run, daemon=True).start()
+
 
 @app.route('/market-data', methods=['GET'])
 def market_data_route():
     if not verify_app_check_token():
         return jsonify({"error":"Unauthorized"}), 401
     r = redis_client()
-    cached = get_cached(r)
+    cached, fresh = get_cached(r)
+    if cached and fresh:
+        return jsonify(cached), 200
     if cached:
+        # stale-while-revalidate: answer now, refresh off the request path
+        refresh_in_background(r)
+        cached["warning"] = "Data may be outdated"
         return jsonify(cached), 200
-    live = get_market_data_live()
+    live = refresh_cache(r)
     if live:
-        set_cached(r, live)
         return jsonify(live), 200
-    # fallback to stale
-    stale = get_cached(r)
-    if stale:
-        stale["warning"] = "Data may be outdated"
-        return jsonify(stale), 200
     return jsonify({"error":"Market data is temporarily unavailable"}), 503
 
 
 @app.route('/health', methods=['GET'])
 def health():
-    r = redis_client()
-    return jsonify({"status":"healthy","redis": bool(r)}), 200
+    try:
+        ok = bool(redis_client().ping())
+    except Exception as e:
+        logger.error("Redis unavailable: %s", e)
+        ok = False
+    return jsonify({"status":"healthy","redis": ok}), 200
 
 
 def main(request):
-    with app.test_request_context(path=request.path, method=request.method, headers=request.headers, data=request.get_data()):
+    # The functions framework already hands us a Flask request: dispatch on its
+    # WSGI environ instead of rebuilding (and re-reading the body of) a test request
+    with app.request_context(request.environ):
         return app.full_dispatch_request()
 
 
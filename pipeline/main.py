@@ -1,22 +1,25 @@
 """
 Phase 1 - Hardened News Pipeline with Integrated Real-time Sentiment
-Single-call Gemini (search + analysis), Pydantic validation, dedupe via set(),
-and 6h rolling sentiment update to market_status/current_sentiment.
+Single-call Gemini (search + analysis), Pydantic validation, dedupe via a Redis
+URL index, and 6h rolling sentiment update to market_status/current_sentiment.
 """
 
 import json
 import logging
 import os
 import re
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any, Optional, Set
 
 import firebase_admin
 from firebase_admin import firestore
 from google.cloud import secretmanager
 import google.generativeai as genai
+import redis
 from tenacity import retry, stop_after_attempt, wait_exponential
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
 from enum import Enum
 
 logging.basicConfig(level=logging.INFO)
@@ -30,6 +33,35 @@ db = firestore.client()
 
 secret_client = secretmanager.SecretManagerServiceClient()
 
+API_KEY_TTL = 3600  # re-fetch hourly so rotated secrets are picked up
+_api_key_cache: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
+
+
+def _get_gemini_api_key(project_id: str) -> str:
+    now = time.monotonic()
+    if _api_key_cache["value"] and now - _api_key_cache["fetched_at"] < API_KEY_TTL:
+        return _api_key_cache["value"]
+    name = f"projects/{project_id}/secrets/gemini-api-key/versions/latest"
+    key = secret_client.access_secret_version(request={"name": name}).payload.data.decode("utf-8")
+    _api_key_cache.update(value=key, fetched_at=now)
+    return key
+
+
+# Dedupe index: sorted set of ingested URLs scored by ingest time (epoch s).
+# Once the key exists it is the only dedupe source, and only this pipeline adds
+# to it (plus a one-off seed from Firestore, scored by publishedAt, when the key
+# is missing), so it must be the only Phase 1 writer deployed: articles saved by
+# serverless/main*.py would not be seen. Needs the VPC connector and REDIS_HOST;
+# without Redis every run falls back to the Firestore scan.
+REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+URLS_KEY = "articles:urls:24h"
+URL_WINDOW = 24 * 3600  # seconds
+_redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, socket_timeout=5, socket_connect_timeout=5)
+
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL)
+
 
 class SentimentEnum(str, Enum):
     POSITIVE = "Positive"
@@ -37,27 +69,54 @@ class SentimentEnum(str, Enum):
     NEUTRAL = "Neutral"
 
 
+VALID_SECTORS = frozenset(["IT","Banking","Pharma","Auto","FMCG","Energy","Metals","Real Estate","Telecom","Power"])
+SENTIMENT_SCORES: Dict[str, int] = {
+    "Positive": 1, "Negative": -1, "Neutral": 0,
+    "positive": 1, "negative": -1, "neutral": 0,
+}
+
+
 class ArticleModel(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     headline: str = Field(..., min_length=1, max_length=500)
     source: str = Field(..., min_length=1, max_length=100)
-    url: str = Field(..., regex=r'^https?://.+')
+    url: str = Field(..., pattern=r'^https?://.+')
     summary: str = Field(..., min_length=10, max_length=1000)
     sentiment: SentimentEnum
-    tickers: List[str] = Field(default_factory=list, max_items=20)
-    sectors: List[str] = Field(default_factory=list, max_items=10)
+    tickers: List[str] = Field(default_factory=list, max_length=20)
+    sectors: List[str] = Field(default_factory=list, max_length=10)
 
-    @validator('tickers')
+    @field_validator('tickers')
+    @classmethod
     def v_tickers(cls, v):
-        return [t.upper().strip() for t in v if t and isinstance(t, str)]
+        return [t.upper() for t in v if t]
 
-    @validator('sectors')
+    @field_validator('sectors')
+    @classmethod
     def v_sectors(cls, v):
-        valid = {"IT","Banking","Pharma","Auto","FMCG","Energy","Metals","Real Estate","Telecom","Power"}
-        return list({s.strip() for s in v if isinstance(s, str) and s.strip() in valid})
+        return list({s for s in v if s in VALID_SECTORS})
 
 
 class ArticleListModel(BaseModel):
-    articles: List[ArticleModel] = Field(default_factory=list, max_items=50)
+    articles: List[ArticleModel] = Field(default_factory=list, max_length=50)
+
+    @field_validator('articles', mode='wrap')
+    @classmethod
+    def drop_invalid(cls, v, handler):
+        # One malformed article shouldn't discard (and re-request) the batch
+        try:
+            return handler(v)
+        except ValidationError:
+            if not isinstance(v, list):
+                raise
+            kept = []
+            for item in v:
+                try:
+                    kept.extend(handler([item]))
+                except ValidationError as e:
+                    logger.warning("Dropping invalid article: %s", e.errors()[0].get('msg'))
+            return handler(kept)
 
 
 class Pipeline:
@@ -73,24 +132,11 @@ class Pipeline:
         "site:sebi.gov.in",
     ]
 
-    def __init__(self):
-        self.project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
-        if not self.project_id:
-            raise ValueError("GOOGLE_CLOUD_PROJECT not set")
-        self.model = self._init_model()
-        self.existing_urls: Set[str] = set()
-
-    def _init_model(self):
-        api_key_name = f"projects/{self.project_id}/secrets/gemini-api-key/versions/latest"
-        api_key = secret_client.access_secret_version(request={"name": api_key_name}).payload.data.decode("utf-8")
-        genai.configure(api_key=api_key)
-        return genai.GenerativeModel("gemini-2.0-flash-exp", tools=[{"google_search": {}}])
-
-    def _combined_prompt(self) -> str:
-        sources = " OR ".join([f'"{s}"' for s in self.NEWS_SOURCES])
-        return f"""
+    # Built once at class load; the prompt has no per-run inputs
+    _SOURCES_QUERY = " OR ".join([f'"{s}"' for s in NEWS_SOURCES])
+    _PROMPT = f"""
 TASK: In one operation, search and analyze latest Indian stock market news.
-SOURCES: {sources}
+SOURCES: {_SOURCES_QUERY}
 WINDOW: last 15-20 minutes. Output ONLY JSON with:
 {{
   "articles": [{{
@@ -106,10 +152,67 @@ WINDOW: last 15-20 minutes. Output ONLY JSON with:
 STRICT: No markdown, no prose outside JSON. Tickers uppercase, sectors from [IT,Banking,Pharma,Auto,FMCG,Energy,Metals,Real Estate,Telecom,Power]. Max 30 articles.
 """
 
-    def _load_existing_urls(self):
-        cutoff = datetime.utcnow() - timedelta(hours=24)
-        q = db.collection('articles').where('publishedAt', '>=', cutoff).select(['url'])
-        self.existing_urls = {d.to_dict().get('url') for d in q.stream() if d.to_dict().get('url')}
+    def __init__(self):
+        self.project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+        if not self.project_id:
+            raise ValueError("GOOGLE_CLOUD_PROJECT not set")
+        self.model = self._init_model()
+        self.existing_urls: Set[str] = set()
+
+    def _init_model(self):
+        genai.configure(api_key=_get_gemini_api_key(self.project_id))
+        return genai.GenerativeModel("gemini-2.0-flash-exp", tools=[{"google_search": {}}])
+
+    def _combined_prompt(self) -> str:
+        return self._PROMPT
+
+    def _load_existing_urls(self, candidates: List[str]):
+        """Mark which candidate URLs were already ingested in the last 24h.
+
+        Checks the Redis index with one round-trip; falls back to scanning the
+        last 24h of Firestore articles when Redis is unavailable or the index
+        has not been built yet (in which case the scan seeds it).
+        """
+        candidates = [u for u in candidates if u]
+        if not candidates:
+            self.existing_urls = set()
+            return
+        seed = False
+        try:
+            cutoff = time.time() - URL_WINDOW
+            pipe = _redis.pipeline()
+            pipe.exists(URLS_KEY)
+            pipe.zmscore(URLS_KEY, candidates)
+            indexed, scores = pipe.execute()
+            if indexed:
+                self.existing_urls = {u for u, sc in zip(candidates, scores) if sc is not None and sc >= cutoff}
+                return
+            seed = True
+        except Exception as e:
+            logger.warning("Redis dedupe unavailable, scanning Firestore: %s", e)
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
+        q = db.collection('articles').where('publishedAt', '>=', cutoff).select(['url', 'publishedAt'])
+        # select() keeps each snapshot to two fields, so to_dict() stays cheap
+        published: Dict[str, float] = {}
+        for d in q.stream():
+            data = d.to_dict()
+            if data.get('url') and data.get('publishedAt'):
+                published[data['url']] = data['publishedAt'].timestamp()
+        self.existing_urls = set(published)
+        if seed and published:
+            # Seeded entries expire 24h after publishing, not 24h after the seed
+            self._remember_urls(published)
+
+    def _remember_urls(self, scored: Dict[str, float]):
+        """Add URLs to the dedupe index (url -> epoch seconds) and trim expired ones"""
+        now = time.time()
+        try:
+            pipe = _redis.pipeline()
+            pipe.zadd(URLS_KEY, scored)
+            pipe.zremrangebyscore(URLS_KEY, 0, now - URL_WINDOW)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Redis dedupe update failed: %s", e)
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=2, max=10))
     def fetch_and_analyze(self) -> List[Dict[str, Any]]:
@@ -120,54 +223,68 @@ STRICT: No markdown, no prose outside JSON. Tickers uppercase, sectors from [IT,
             "response_mime_type": "application/json"
         })
         text = (resp.text or "").strip()
-        # Strip markdown fences if any
-        m = re.search(r"```json\s*(.*?)\s*```", text, re.DOTALL)
-        if m:
-            text = m.group(1)
-        data = json.loads(text)
-        validated = ArticleListModel(**data)
-        return [a.dict() for a in validated.articles]
+        # Strip markdown fences if any; JSON mode normally returns bare JSON
+        if text.startswith("```"):
+            m = _FENCE_RE.match(text)
+            if m:
+                text = m.group(1)
+        # pydantic-core parses and validates the JSON in a single pass
+        validated = ArticleListModel.model_validate_json(text.encode())
+        return [a.model_dump() for a in validated.articles]
 
     def _filter_new(self, articles: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        out = []
+        # Keyed on URL so repeats within the same Gemini response collapse too
+        fresh: Dict[str, Dict[str, Any]] = {}
         for a in articles:
             url = a.get('url')
-            if url and url not in self.existing_urls:
-                out.append(a)
-        return out
+            if url and url not in self.existing_urls and url not in fresh:
+                fresh[url] = a
+        self.existing_urls.update(fresh)
+        return list(fresh.values())
 
-    def _batch_save(self, articles: List[Dict[str, Any]]) -> int:
+    def _batch_save(self, articles: List[Dict[str, Any]]) -> List[str]:
+        """Save articles; returns the URLs of the writes Firestore acknowledged"""
         if not articles:
-            return 0
-        batch = db.batch()
+            return []
+        # BulkWriter splits into 500-op batches and commits them in parallel.
+        # close() doesn't raise on failed writes, so only acknowledged writes
+        # are counted; callbacks may run on the writer's worker threads
+        writer = db.bulk_writer()
         ref = db.collection('articles')
-        count = 0
+        pending: Dict[str, str] = {}
+        saved: List[str] = []
+        lock = threading.Lock()
+
+        def on_write_result(reference, result, bulk_writer):
+            with lock:
+                saved.append(pending[reference.path])
+
+        writer.on_write_result(on_write_result)
         for a in articles:
-            doc = ref.document()
-            payload = {**a, "publishedAt": firestore.SERVER_TIMESTAMP, "processedAt": firestore.SERVER_TIMESTAMP}
-            batch.set(doc, payload)
-            count += 1
-        batch.commit()
-        return count
+            payload = {
+                **a,
+                "sentimentScore": self._sentiment_to_score(a.get('sentiment')),
+                "publishedAt": firestore.SERVER_TIMESTAMP,
+            }
+            doc_ref = ref.document()
+            pending[doc_ref.path] = a['url']
+            writer.create(doc_ref, payload)
+        writer.close()
+        return saved
 
     def _sentiment_to_score(self, s: str) -> int:
-        s = (s or '').lower()
-        if s == 'positive':
-            return 1
-        if s == 'negative':
-            return -1
-        return 0
+        return SENTIMENT_SCORES.get(s, 0)
 
     def update_realtime_sentiment(self) -> Dict[str, Any]:
-        end = datetime.utcnow()
+        end = datetime.now(timezone.utc)
         start = end - timedelta(hours=6)
         q = db.collection('articles').where('publishedAt', '>=', start).where('publishedAt', '<=', end)
-        scores = []
-        total = 0
-        for d in q.stream():
-            total += 1
-            scores.append(self._sentiment_to_score(d.to_dict().get('sentiment', 'Neutral')))
-        avg = sum(scores) / len(scores) if scores else 0.0
+        # Server-side aggregation over the precomputed sentimentScore field:
+        # one RPC, no documents transferred.
+        agg = q.count(alias='total').avg('sentimentScore', alias='avg')
+        res = {r.alias: r.value for r in agg.get()[0]}
+        total = int(res.get('total') or 0)
+        avg = res.get('avg') or 0.0
         doc = db.collection('market_status').document('current_sentiment')
         payload = {
             "averageScore": round(avg, 3),
@@ -181,12 +298,16 @@ STRICT: No markdown, no prose outside JSON. Tickers uppercase, sectors from [IT,
     def run(self) -> Dict[str, Any]:
         stats = {"fetched": 0, "new_articles": 0, "saved": 0, "errors": 0}
         try:
-            self._load_existing_urls()
             articles = self.fetch_and_analyze()
             stats["fetched"] = len(articles)
+            self._load_existing_urls([a.get('url') for a in articles])
             new_articles = self._filter_new(articles)
             stats["new_articles"] = len(new_articles)
-            stats["saved"] = self._batch_save(new_articles)
+            saved_urls = self._batch_save(new_articles)
+            stats["saved"] = len(saved_urls)
+            if saved_urls:
+                # Failed writes stay out of the index so the next run retries them
+                self._remember_urls(dict.fromkeys(saved_urls, time.time()))
             self.update_realtime_sentiment()
             return stats
         except Exception as e:
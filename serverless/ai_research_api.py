@@ -7,6 +7,7 @@ Uses Gemini with Google Search grounding to produce structured, citeable market
 import json
 import logging
 import os
+import time
 from datetime import datetime
 from typing import Any, Dict
 
@@ -30,25 +31,38 @@ CORS(app, origins=[
 secret_client = secretmanager.SecretManagerServiceClient()
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
 
+# Warm instances reuse the key and model; re-fetch hourly to pick up rotation
+API_KEY_TTL = 3600
+_api_key_cache: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
+_model_cache: Dict[str, Any] = {"model": None, "api_key": None}
+
 
 def _get_gemini_api_key() -> str:
+  now = time.monotonic()
+  if _api_key_cache["value"] and now - _api_key_cache["fetched_at"] < API_KEY_TTL:
+    return _api_key_cache["value"]
   secret_name = f"projects/{PROJECT_ID}/secrets/gemini-api-key/versions/latest"
   resp = secret_client.access_secret_version(request={"name": secret_name})
-  return resp.payload.data.decode("utf-8")
+  key = resp.payload.data.decode("utf-8")
+  _api_key_cache.update(value=key, fetched_at=now)
+  return key
 
 
 def _init_model():
   api_key = _get_gemini_api_key()
+  if _model_cache["model"] is not None and _model_cache["api_key"] == api_key:
+    return _model_cache["model"]
   genai.configure(api_key=api_key)
   model = genai.GenerativeModel(
     "gemini-2.0-flash-exp",
     tools=[{"google_search": {}}]
   )
+  _model_cache.update(model=model, api_key=api_key)
   return model
 
 
-def _build_prompt(question: str) -> str:
-  return f"""
+# Template is parsed once; each request does a single str.format substitution
+RESEARCH_PROMPT_TEMPLATE = """
 ROLE: You are a professional Indian equity market research analyst.
 AUDIENCE: Sophisticated investors and financial professionals.
 SCOPE: Use Google Search grounding to find the latest credible news, filings, and data from top Indian sources.
@@ -82,6 +96,10 @@ REQUIREMENTS:
 """
 
 
+def _build_prompt(question: str) -> str:
+  return RESEARCH_PROMPT_TEMPLATE.format(question=question)
+
+
 @app.route("/ai/research", methods=["POST"])  
 def ai_research_http():
   try:
@@ -123,10 +141,7 @@ def ai_research_http():
 
 
 def ai_research_function(request):
-  with app.test_request_context(
-    path=request.path,
-    method=request.method,
-    headers=request.headers,
-    data=request.get_data()
-  ):
+  # The functions framework already hands us a Flask request: dispatch on its
+  # WSGI environ instead of rebuilding (and re-reading the body of) a test request
+  with app.request_context(request.environ):
     return app.full_dispatch_request()
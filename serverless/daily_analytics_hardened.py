@@ -3,14 +3,19 @@ AI Market Insights - Hardened Daily Analytics Engine (SRE Audit Fixes)
 Scalable batch-query implementation for daily sentiment analytics
 """
 
+import asyncio
 import json
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
-from collections import defaultdict
+from itertools import chain
+from typing import Dict, List, Any, Optional, Tuple
 
+import numpy as np
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore import AsyncClient
+
+from firestore_utils import run_with_async_client, snapshot_field
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +34,27 @@ SECTORS = [
     "Energy", "Metals", "Real Estate", "Telecom", "Power"
 ]
 
+# Group index per sector for np.bincount aggregation
+SECTOR_INDEX = {name: i for i, name in enumerate(SECTORS)}
+_SECTOR_SET = frozenset(SECTORS)
+# Sentiment label -> score; anything missing (Neutral/unknown) scores 0
+SENT_SCORE = {
+    "Positive": 1, "positive": 1, "POSITIVE": 1,
+    "Negative": -1, "negative": -1, "NEGATIVE": -1,
+}
+
+
+class DailyAggState:
+    """Running sums and counts for one day's sentiment (no per-article storage)"""
+    __slots__ = ('overall_sum', 'overall_count', 'sector_state')
+    
+    def __init__(self, n_sectors: int = len(SECTORS)):
+        self.overall_sum = 0
+        self.overall_count = 0
+        # One row per sector: column 0 = score sum, column 1 = article count
+        # (float: server-side sums are avg * count, see _aggregate_server_side)
+        self.sector_state = np.zeros((n_sectors, 2), dtype=np.float64)
+
 
 class DailyAnalyticsHardened:
     """
@@ -43,41 +69,122 @@ class DailyAnalyticsHardened:
         self.db = db
         self.batch_size = 1000  # SRE Fix: Process articles in batches
     
-    def _sentiment_to_score(self, sentiment: str) -> int:
-        """Convert sentiment string to numerical score"""
-        sentiment_lower = sentiment.lower()
-        if sentiment_lower == "positive":
-            return 1
-        elif sentiment_lower == "negative":
-            return -1
-        else:  # neutral or unknown
-            return 0
-    
-    def _process_article_batch(self, articles: List[Dict[str, Any]], 
-                              overall_scores: List[int], 
-                              sector_scores: Dict[str, List[int]]) -> None:
+    def _process_article_batch(self, docs: List[Any], state: DailyAggState) -> None:
         """
-        SRE Fix: Process a batch of articles and update aggregate counters
-        This keeps memory usage constant regardless of total article count
+        SRE Fix: Vectorized batch aggregation (accumarray / groupby pattern)
+        Scores become an int8 array and per-sector sums/counts are accumulated
+        in place with np.bincount, so memory stays constant across batches
         """
-        for article in articles:
-            # Process overall sentiment
-            sentiment = article.get('sentiment', 'Neutral')
-            score = self._sentiment_to_score(sentiment)
-            overall_scores.append(score)
-            
-            # SRE Fix: Process sectors directly from article data
-            # No more ticker-to-sector mapping - sectors come from Phase 1
-            sectors = article.get('sectors', [])
-            for sector in sectors:
-                if sector in SECTORS:  # Validate sector
-                    sector_scores[sector].append(score)
+        scores = np.fromiter(
+            (SENT_SCORE.get(snapshot_field(doc, 'sentiment'), 0) for doc in docs),
+            dtype=np.int8, count=len(docs)
+        )
+        state.overall_sum += int(scores.sum())
+        state.overall_count += len(docs)
+        
+        # Sectors come from Phase 1; the intersection drops unknown sectors and
+        # counts an article once per sector, matching the array-contains queries.
+        # CSR layout: per-article sector counts plus one flat index array.
+        sector_lists = [[SECTOR_INDEX[sector] for sector in
+                         _SECTOR_SET.intersection(snapshot_field(doc, 'sectors') or ())]
+                        for doc in docs]
+        counts = np.fromiter(map(len, sector_lists), dtype=np.intp, count=len(docs))
+        total = int(counts.sum())
+        if total:
+            sector_idx = np.fromiter(chain.from_iterable(sector_lists), dtype=np.intp, count=total)
+            state.sector_state[:, 0] += np.bincount(sector_idx, weights=np.repeat(scores, counts),
+                                                    minlength=len(SECTORS)).astype(np.int64)
+            state.sector_state[:, 1] += np.bincount(sector_idx, minlength=len(SECTORS))
     
     def calculate_daily_analytics_batched(self, target_date: str = None) -> Dict[str, Any]:
         """
         SRE Fix: Scalable daily analytics using batched queries
         This prevents OOM crashes by processing articles in batches
         """
+        return run_with_async_client(
+            lambda async_db: self._calculate_daily_analytics_async(target_date, async_db))
+    
+    async def _aggregate_server_side(self, async_db: AsyncClient, start_time: datetime,
+                                     end_time: datetime) -> DailyAggState:
+        """
+        SRE Fix: Firestore count()/avg() aggregation queries instead of a client-side scan
+        One query for the day plus one array-contains query per sector (11 reads
+        total); requires a composite index on (sectors array-contains, publishedAt).
+        avg() skips articles saved before Phase 1 wrote sentimentScore, so they
+        count as analyzed without pulling the mean towards 0; sums are avg * count
+        """
+        base = (async_db.collection('articles')
+                .where('publishedAt', '>=', start_time)
+                .where('publishedAt', '<', end_time))
+        queries = [base] + [base.where('sectors', 'array_contains', sector) for sector in SECTORS]
+        
+        async def run(query) -> Tuple[float, int]:
+            results = await query.count(alias='count').avg('sentimentScore', alias='mean').get()
+            values = {r.alias: r.value for r in results[0]}
+            count = int(values.get('count') or 0)
+            return float(values.get('mean') or 0.0) * count, count
+        
+        (score_sum, article_count), *per_sector = await asyncio.gather(*(run(q) for q in queries))
+        state = DailyAggState()
+        state.overall_sum = score_sum
+        state.overall_count = article_count
+        state.sector_state[:] = per_sector
+        return state
+    
+    async def _aggregate_by_scan(self, async_db: AsyncClient, start_time: datetime,
+                                 end_time: datetime) -> DailyAggState:
+        """
+        Batched aggregation with overlapped prefetch: batch N+1 is requested
+        as soon as batch N arrives, while batch N is aggregated off the loop
+        """
+        # SRE Fix: Initialize aggregate counters
+        state = DailyAggState()
+        
+        # SRE Fix: Batched query processing
+        # Projection: only the aggregated fields (publishedAt kept for the cursor).
+        # The base query is built once; only the cursor changes per page.
+        base_query = (async_db.collection('articles')
+                     .where('publishedAt', '>=', start_time)
+                     .where('publishedAt', '<', end_time)
+                     .order_by('publishedAt')
+                     .order_by('__name__')
+                     .select(['sentiment', 'sectors', 'publishedAt'])
+                     .limit(self.batch_size))
+        
+        # Keyset pagination: the cursor is the last (publishedAt, document id)
+        # pair rather than a snapshot, so each page is a fresh stateless query.
+        # The id tiebreaks articles batch-written with the same server timestamp.
+        async def fetch_batch(last_key: Optional[Tuple[datetime, str]]):
+            batch_query = base_query
+            if last_key is not None:
+                last_ts, last_id = last_key
+                batch_query = base_query.start_after({'publishedAt': last_ts, '__name__': last_id})
+            return [doc async for doc in batch_query.stream()]
+        
+        docs = await fetch_batch(None)
+        
+        while docs:
+            # Prefetch the next batch before aggregating this one
+            next_batch = None
+            if len(docs) == self.batch_size:
+                last_key = (docs[-1].get('publishedAt'), docs[-1].id)
+                next_batch = asyncio.create_task(fetch_batch(last_key))
+            
+            # Process this batch in a worker thread so the prefetch keeps running
+            await asyncio.to_thread(self._process_article_batch, docs, state)
+            
+            logger.info(f"Processed batch of {len(docs)} articles (total: {state.overall_count})")
+            
+            if next_batch is None:
+                logger.info("Reached end of data (partial batch)")
+                break
+            docs = await next_batch
+        
+        return state
+    
+    async def _calculate_daily_analytics_async(self, target_date: Optional[str],
+                                               async_db: AsyncClient) -> Dict[str, Any]:
+        """Compute the day's sentiment aggregates (see calculate_daily_analytics_batched)"""
         try:
             logger.info(f"Starting batched daily analytics calculation for {target_date or 'today'}...")
             
@@ -91,79 +198,40 @@ class DailyAnalyticsHardened:
             start_time = target_datetime
             end_time = start_time + timedelta(days=1)
             
-            # SRE Fix: Initialize aggregate counters
-            overall_scores = []
-            sector_scores = defaultdict(list)
-            total_articles = 0
-            
-            # SRE Fix: Batched query processing
-            articles_ref = self.db.collection('articles')
-            query = (articles_ref
-                    .where('publishedAt', '>=', start_time)
-                    .where('publishedAt', '<', end_time)
-                    .order_by('publishedAt')
-                    .limit(self.batch_size))
-            
-            last_doc = None
-            
-            while True:
-                # Execute query with cursor
-                if last_doc:
-                    query = query.start_after(last_doc)
-                
-                docs = list(query.stream())
-                
-                if not docs:
-                    logger.info("No more documents to process")
-                    break
-                
-                # Convert documents to dictionaries
-                articles = []
-                for doc in docs:
-                    article_data = doc.to_dict()
-                    articles.append(article_data)
-                
-                # Process this batch
-                self._process_article_batch(articles, overall_scores, sector_scores)
-                total_articles += len(articles)
-                
-                # Update cursor for next batch
-                last_doc = docs[-1]
-                
-                logger.info(f"Processed batch of {len(articles)} articles (total: {total_articles})")
-                
-                # Safety check to prevent infinite loops
-                if len(docs) < self.batch_size:
-                    logger.info("Reached end of data (partial batch)")
-                    break
+            # SRE Fix: Server-side aggregation, then a batched scan
+            try:
+                state = await self._aggregate_server_side(async_db, start_time, end_time)
+                source, batches = "aggregation", 0
+            except Exception as e:
+                logger.warning(f"Aggregation query failed ({str(e)}), falling back to batched scan")
+                state = await self._aggregate_by_scan(async_db, start_time, end_time)
+                source = "scan"
+                batches = (state.overall_count + self.batch_size - 1) // self.batch_size
+            total_articles = state.overall_count
             
             if total_articles == 0:
                 logger.warning(f"No articles found for {target_date}, creating empty record")
                 return self._create_empty_daily_record(target_date or target_datetime.strftime("%Y-%m-%d"))
             
             # Calculate final averages
-            overall_sentiment = sum(overall_scores) / len(overall_scores) if overall_scores else 0.0
+            overall_sentiment = state.overall_sum / total_articles
             
-            # Calculate sector breakdown
-            sector_breakdown = {}
-            for sector in SECTORS:
-                if sector in sector_scores and sector_scores[sector]:
-                    sector_avg = sum(sector_scores[sector]) / len(sector_scores[sector])
-                    sector_breakdown[sector] = round(sector_avg, 3)
-                else:
-                    sector_breakdown[sector] = 0.0
+            # Calculate sector breakdown (sectors without articles stay at 0.0)
+            sector_avgs = state.sector_state[:, 0] / np.maximum(state.sector_state[:, 1], 1)
+            sector_breakdown = dict(zip(SECTORS, np.round(sector_avgs, 3).tolist()))
             
             result = {
                 "date": target_date or target_datetime.strftime("%Y-%m-%d"),
-                "overallSentimentScore": round(overall_sentiment, 3),
+                "overallSentimentScore": round(float(overall_sentiment), 3),
                 "articlesAnalyzed": total_articles,
                 "sectorBreakdown": sector_breakdown,
                 "lastUpdated": firestore.SERVER_TIMESTAMP,
                 "processingTime": datetime.utcnow().isoformat(),
-                "batchesProcessed": (total_articles + self.batch_size - 1) // self.batch_size
+                "source": source,
+                "batchesProcessed": batches
             }
             
-            logger.info(f"Daily analytics calculated: {overall_sentiment:.3f} from {total_articles} articles in batches")
+            logger.info(f"Daily analytics calculated: {overall_sentiment:.3f} from {total_articles} articles ({source})")
             return result
             
         except Exception as e:
@@ -24,6 +24,8 @@ gcloud functions deploy $FUNCTION_NAME \
   --allow-unauthenticated \
   --timeout=300s \
   --memory=512MB \
+  --cpu=1 \
+  --concurrency=80 \
   --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID"
 
 echo "Deployment complete!"
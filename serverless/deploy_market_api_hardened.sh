@@ -42,6 +42,13 @@ gcloud compute networks vpc-access connectors create $VPC_CONNECTOR_NAME \
 echo "Creating secret for financial API key..."
 echo "your-api-key-here" | gcloud secrets create financial-api-key --data-file=- || echo "Secret already exists"
 
+# Service account Cloud Scheduler uses to sign the cache invalidation calls
+INVALIDATOR_SA="market-data-invalidator@${PROJECT_ID}.iam.gserviceaccount.com"
+FUNCTION_URL="https://${REGION}-${PROJECT_ID}.cloudfunctions.net/${FUNCTION_NAME}"
+echo "Creating cache invalidation service account..."
+gcloud iam service-accounts create market-data-invalidator \
+  --display-name="Market Data Cache Invalidator" || echo "Service account may already exist"
+
 # Deploy the hardened function with all SRE fixes
 echo "Deploying hardened market data API function..."
 gcloud functions deploy $FUNCTION_NAME \
@@ -55,8 +62,21 @@ gcloud functions deploy $FUNCTION_NAME \
   --timeout=30s \
   --memory=512MB \
   --max-instances=100 \
+  --cpu=1 \
+  --concurrency=80 \
   --vpc-connector=$VPC_CONNECTOR_NAME \
-  --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID,REDIS_HOST=$REDIS_HOST,REDIS_PORT=$REDIS_PORT"
+  --set-env-vars="GOOGLE_CLOUD_PROJECT=$PROJECT_ID,REDIS_HOST=$REDIS_HOST,REDIS_PORT=$REDIS_PORT,INVALIDATE_SERVICE_ACCOUNT=$INVALIDATOR_SA,INVALIDATE_AUDIENCE=$FUNCTION_URL"
+
+# Invalidate the cache on each market tick so reads pick up fresh quotes
+echo "Creating cache invalidation scheduler job..."
+gcloud scheduler jobs create http market-data-invalidate \
+  --location=$REGION \
+  --schedule="* 9-15 * * 1-5" \
+  --time-zone="Asia/Kolkata" \
+  --http-method=POST \
+  --uri="${FUNCTION_URL}/internal/invalidate" \
+  --oidc-service-account-email=$INVALIDATOR_SA \
+  --oidc-token-audience=$FUNCTION_URL || echo "Scheduler job may already exist"
 
 echo "Deployment complete!"
 echo ""
@@ -34,6 +34,19 @@ gcloud functions deploy daily-analytics-engine \
   --timeout=540s \
   --memory=1GB
 
+# Deploy Daily Analytics Backfill Function (on demand, no scheduler job)
+echo "Deploying Daily Analytics Backfill Function..."
+gcloud functions deploy daily-analytics-backfill \
+  --gen2 \
+  --runtime=$RUNTIME \
+  --region=$REGION \
+  --source=. \
+  --entry-point=backfill_range \
+  --trigger-http \
+  --no-allow-unauthenticated \
+  --timeout=540s \
+  --memory=1GB
+
 # Create Cloud Scheduler jobs
 
 # Real-time Sentiment Gauge - every 15 minutes (offset by 5 minutes from Phase 1)
@@ -61,6 +74,7 @@ echo ""
 echo "Function URLs:"
 echo "Real-time Sentiment Gauge: https://${REGION}-${PROJECT_ID}.cloudfunctions.net/real-time-sentiment-gauge"
 echo "Daily Analytics Engine: https://${REGION}-${PROJECT_ID}.cloudfunctions.net/daily-analytics-engine"
+echo "Daily Analytics Backfill: https://${REGION}-${PROJECT_ID}.cloudfunctions.net/daily-analytics-backfill"
 echo ""
 echo "Test the functions:"
 echo "curl https://${REGION}-${PROJECT_ID}.cloudfunctions.net/real-time-sentiment-gauge"
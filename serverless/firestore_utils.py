@@ -0,0 +1,54 @@
+"""
+Shared Firestore helpers for the serverless functions
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from google.cloud.firestore import AsyncClient
+
+T = TypeVar("T")
+
+# One event loop per process, running on a daemon thread, and one AsyncClient
+# bound to it: grpc.aio channels belong to the loop that created them, so a
+# long-lived loop lets warm instances reuse the channel instead of opening
+# (and having to close) one per asyncio.run()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_async_db: Optional[AsyncClient] = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Start the process-wide Firestore event loop on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="firestore-async", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+async def _with_client(fn: Callable[[AsyncClient], Awaitable[T]]) -> T:
+    global _async_db
+    # Only ever runs on the shared loop's thread, so no lock is needed
+    if _async_db is None:
+        _async_db = AsyncClient()
+    return await fn(_async_db)
+
+
+def run_with_async_client(fn: Callable[[AsyncClient], Awaitable[T]]) -> T:
+    """
+    Run fn(async_db) on the shared event loop and block until it finishes;
+    safe to call from several request threads at once
+    """
+    return asyncio.run_coroutine_threadsafe(_with_client(fn), _get_loop()).result()
+
+
+def snapshot_field(doc, field: str, default: Any = None) -> Any:
+    """Read one field from a DocumentSnapshot without building its full dict"""
+    try:
+        return doc.get(field)
+    except KeyError:
+        return default
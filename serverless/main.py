@@ -6,10 +6,12 @@ Automatically fetches, analyzes, and stores Indian stock market news
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 from urllib.parse import urlparse
 
+import orjson
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud import functions_v2
@@ -27,6 +29,9 @@ except ValueError:
     firebase_admin.initialize_app()
 db = firestore.client()
 
+# Numeric sentiment stored with each article so analytics can use count()/sum() aggregations
+SENTIMENT_SCORES = {"Positive": 1, "Negative": -1, "Neutral": 0}
+
 # Configure Gemini
 genai.configure(api_key="YOUR_GEMINI_API_KEY")  # Set this in environment variables
 
@@ -44,37 +49,101 @@ class NewsPipeline:
         "site:thehindubusinessline.com",
     ]
     
+    # Search prompt is static, so it is built once at class creation
+    _SOURCES_QUERY = " OR ".join([f'"{src}"' for src in NEWS_SOURCES])
+    _SEARCH_QUERY = f"""
+    Find recent Indian stock market news articles published in the last 15-20 minutes from these sources:
+    {_SOURCES_QUERY}
+    
+    Return the article URLs and headlines for articles about:
+    - Stock market news
+    - Company earnings and results
+    - Economic indicators
+    - Sector-specific news (banking, IT, pharma, auto, etc.)
+    - Corporate announcements
+    - Market analysis and trends
+    - IPOs and listings
+    
+    Provide only recent articles published within the last 15-20 minutes.
+    Format the response as a JSON array with objects containing 'url' and 'headline' fields.
+    """
+    
+    # Concurrent Gemini analysis calls per run
+    ANALYZE_CONCURRENCY = 8
+    
+    # Articles per WriteBatch (Firestore allows 500 writes per commit)
+    WRITE_BATCH_SIZE = 500
+    
+    # Firestore caps the number of values in an 'in' filter
+    IN_QUERY_LIMIT = 30
+    
+    # Response parsing works on bytes: orjson takes them directly, no re-decoding
+    _JSON_BLOCK_RE = re.compile(rb'```json\s*(.*?)\s*```', re.DOTALL)
+    _URL_RE = re.compile(rb'https?://[^\s<>"{}|\\^`\[\]]+')
+    
+    # Static analysis instructions: sent once as the system instruction so the
+    # per-article prompt is only the URL and headline (and the fixed prefix is
+    # eligible for Gemini's implicit prompt caching)
+    ANALYSIS_INSTRUCTION = """
+    Analyze the content of the article given by URL and headline.
+    
+    Please fetch and read the full article content from the URL, then provide a comprehensive analysis.
+    
+    Return ONLY a valid JSON object with the following structure:
+    - headline: Extract or use the article's headline
+    - source: The common name of the news source (e.g., "Moneycontrol", "The Economic Times")
+    - url: The article URL
+    - summary: A concise 1-2 sentence summary highlighting the key financial/economic impact
+    - sentiment: One of "Positive", "Negative", or "Neutral" based on the impact on markets/stocks
+    - tickers: Array of relevant Indian stock ticker symbols in UPPERCASE (e.g., ["RELIANCE", "TCS"]). Empty array [] if none apply.
+    
+    Focus on:
+    1. Clear identification of affected companies/sectors
+    2. Impact assessment (positive/negative/neutral)
+    3. Key facts that would influence market decisions
+    
+    Return ONLY JSON, no additional text or explanation.
+    """
+    
+    ANALYSIS_SCHEMA = {
+        "type": "OBJECT",
+        "properties": {
+            "headline": {"type": "STRING"},
+            "source": {
+                "type": "STRING",
+                "description": "The common name of the news source, e.g., 'The Economic Times'"
+            },
+            "url": {"type": "STRING"},
+            "summary": {
+                "type": "STRING",
+                "description": "A concise 1-2 sentence AI summary of the key impact."
+            },
+            "sentiment": {
+                "type": "STRING",
+                "enum": ["Positive", "Negative", "Neutral"]
+            },
+            "tickers": {
+                "type": "ARRAY",
+                "items": {"type": "STRING"},
+                "description": "A list of relevant Indian stock tickers, e.g., ['RELIANCE', 'TCS']. Use uppercase. Provide an empty array if none."
+            }
+        },
+        "required": ["headline", "source", "url", "summary", "sentiment", "tickers"]
+    }
+    
     def __init__(self):
         self.model = genai.GenerativeModel(
             'gemini-2.0-flash-exp',
             tools=[{"google_search": {}}]
         )
-        self.analysis_model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        self.analysis_model = genai.GenerativeModel(
+            'gemini-2.0-flash-exp',
+            system_instruction=self.ANALYSIS_INSTRUCTION
+        )
         
     def _build_search_query(self) -> str:
         """Build a Google Search query for recent articles"""
-        time_window = "15 minutes ago"
-        
-        sources_query = " OR ".join([f'"{src}"' for src in self.NEWS_SOURCES])
-        
-        query = f"""
-        Find recent Indian stock market news articles published in the last 15-20 minutes from these sources:
-        {sources_query}
-        
-        Return the article URLs and headlines for articles about:
-        - Stock market news
-        - Company earnings and results
-        - Economic indicators
-        - Sector-specific news (banking, IT, pharma, auto, etc.)
-        - Corporate announcements
-        - Market analysis and trends
-        - IPOs and listings
-        
-        Provide only recent articles published within the last 15-20 minutes.
-        Format the response as a JSON array with objects containing 'url' and 'headline' fields.
-        """
-        
-        return query
+        return self._SEARCH_QUERY
     
     @retry(
         stop=stop_after_attempt(3),
@@ -115,15 +184,13 @@ class NewsPipeline:
         try:
             # Try to parse as JSON
             # Extract JSON from markdown code blocks if present
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
+            raw = response_text.encode()
+            json_match = self._JSON_BLOCK_RE.search(raw)
             if json_match:
-                response_text = json_match.group(1)
+                raw = json_match.group(1)
             
-            # Clean up the response
-            response_text = response_text.strip()
-            
-            # Parse JSON
-            data = json.loads(response_text)
+            # Parse JSON (orjson ignores surrounding whitespace)
+            data = orjson.loads(raw)
             
             if isinstance(data, list):
                 for item in data:
@@ -136,10 +203,8 @@ class NewsPipeline:
         except json.JSONDecodeError:
             logger.warning("Failed to parse response as JSON, attempting regex extraction")
             # Fallback: extract URLs using regex
-            url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+'
-            urls = re.findall(url_pattern, response_text)
-            
-            for url in urls:
+            for match in self._URL_RE.findall(response_text.encode()):
+                url = match.decode()
                 # Skip URLs that don't match our sources
                 if any(source.replace('site:', '') in url for source in self.NEWS_SOURCES):
                     articles.append({
@@ -149,19 +214,19 @@ class NewsPipeline:
         
         return articles
     
-    def check_duplicate(self, url: str) -> bool:
-        """Check if an article with this URL already exists in Firestore"""
-        try:
-            articles_ref = db.collection('articles')
-            query = articles_ref.where('url', '==', url).limit(1)
-            docs = query.stream()
-            
-            exists = any(True for _ in docs)
-            return exists
-            
-        except Exception as e:
-            logger.error(f"Error checking duplicate for {url}: {str(e)}")
-            return False  # If error, skip rather than crash
+    def find_existing_urls(self, urls: List[str]) -> Set[str]:
+        """Return the subset of urls already stored in Firestore (one IN query per chunk)"""
+        existing = set()
+        articles_ref = db.collection('articles')
+        for i in range(0, len(urls), self.IN_QUERY_LIMIT):
+            chunk = urls[i:i + self.IN_QUERY_LIMIT]
+            try:
+                docs = articles_ref.where('url', 'in', chunk).select(['url']).stream()
+                existing.update(doc.get('url') for doc in docs)
+            except Exception as e:
+                logger.error(f"Error checking duplicates for {len(chunk)} URLs: {str(e)}")
+                # If error, treat the chunk as new rather than crash
+        return existing
     
     @retry(
         stop=stop_after_attempt(3),
@@ -175,66 +240,19 @@ class NewsPipeline:
         try:
             logger.info(f"Analyzing article: {headline}")
             
-            schema = {
-                "type": "OBJECT",
-                "properties": {
-                    "headline": {"type": "STRING"},
-                    "source": {
-                        "type": "STRING",
-                        "description": "The common name of the news source, e.g., 'The Economic Times'"
-                    },
-                    "url": {"type": "STRING"},
-                    "summary": {
-                        "type": "STRING",
-                        "description": "A concise 1-2 sentence AI summary of the key impact."
-                    },
-                    "sentiment": {
-                        "type": "STRING",
-                        "enum": ["Positive", "Negative", "Neutral"]
-                    },
-                    "tickers": {
-                        "type": "ARRAY",
-                        "items": {"type": "STRING"},
-                        "description": "A list of relevant Indian stock tickers, e.g., ['RELIANCE', 'TCS']. Use uppercase. Provide an empty array if none."
-                    }
-                },
-                "required": ["headline", "source", "url", "summary", "sentiment", "tickers"]
-            }
-            
-            prompt = f"""
-            Analyze the content of this article:
-            URL: {url}
-            Headline: {headline}
-            
-            Please fetch and read the full article content from the URL, then provide a comprehensive analysis.
-            
-            Return ONLY a valid JSON object with the following structure:
-            - headline: Extract or use the article's headline
-            - source: The common name of the news source (e.g., "Moneycontrol", "The Economic Times")
-            - url: The article URL
-            - summary: A concise 1-2 sentence summary highlighting the key financial/economic impact
-            - sentiment: One of "Positive", "Negative", or "Neutral" based on the impact on markets/stocks
-            - tickers: Array of relevant Indian stock ticker symbols in UPPERCASE (e.g., ["RELIANCE", "TCS"]). Empty array [] if none apply.
-            
-            Focus on:
-            1. Clear identification of affected companies/sectors
-            2. Impact assessment (positive/negative/neutral)
-            3. Key facts that would influence market decisions
-            
-            Return ONLY JSON, no additional text or explanation.
-            """
+            prompt = f"URL: {url}\nHeadline: {headline}"
             
             response = self.analysis_model.generate_content(
                 prompt,
                 generation_config={
                     "temperature": 0.2,
                     "response_mime_type": "application/json",
-                    "response_schema": schema,
+                    "response_schema": self.ANALYSIS_SCHEMA,
                 }
             )
             
             # Parse and validate JSON response
-            analysis = json.loads(response.text)
+            analysis = orjson.loads(response.text.encode())
             
             # Validate required fields
             required_fields = ["headline", "source", "url", "summary", "sentiment", "tickers"]
@@ -248,6 +266,9 @@ class NewsPipeline:
                 logger.warning(f"Invalid sentiment '{analysis['sentiment']}', defaulting to 'Neutral'")
                 analysis["sentiment"] = "Neutral"
             
+            # Store tickers uppercase so sector lookups downstream can match them as-is
+            analysis["tickers"] = [ticker.strip().upper() for ticker in analysis["tickers"] if ticker.strip()]
+            
             logger.info(f"Successfully analyzed article: {analysis.get('headline', url)}")
             return analysis
             
@@ -258,24 +279,48 @@ class NewsPipeline:
             logger.error(f"Error analyzing article {url}: {str(e)}")
             return None
     
-    def save_to_firestore(self, analysis: Dict[str, Any]) -> bool:
-        """Save the analyzed article to Firestore"""
-        try:
-            article_data = {
-                **analysis,
-                "publishedAt": firestore.SERVER_TIMESTAMP,
-                "processedAt": firestore.SERVER_TIMESTAMP,
-            }
-            
-            # Add document to Firestore
-            db.collection('articles').add(article_data)
-            
-            logger.info(f"Saved article to Firestore: {analysis.get('headline')}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Error saving to Firestore: {str(e)}")
-            return False
+    def save_to_firestore(self, analyses: List[Dict[str, Any]]) -> int:
+        """
+        Save analyzed articles with one WriteBatch commit per WRITE_BATCH_SIZE
+        articles. Returns the number of articles saved
+        """
+        saved = 0
+        articles_ref = db.collection('articles')
+        
+        for i in range(0, len(analyses), self.WRITE_BATCH_SIZE):
+            chunk = analyses[i:i + self.WRITE_BATCH_SIZE]
+            try:
+                batch = db.batch()
+                for analysis in chunk:
+                    score = SENTIMENT_SCORES.get(analysis.get("sentiment"), 0)
+                    batch.set(articles_ref.document(), {
+                        **analysis,
+                        "sentimentScore": score,
+                        "publishedAt": firestore.SERVER_TIMESTAMP,
+                        "processedAt": firestore.SERVER_TIMESTAMP,
+                    })
+                batch.commit()
+                
+                saved += len(chunk)
+                logger.info(f"Saved {len(chunk)} articles to Firestore")
+                
+            except Exception as e:
+                logger.error(f"Error saving {len(chunk)} articles to Firestore: {str(e)}")
+        
+        return saved
+    
+    def _analyze_all(self, articles: List[Dict[str, str]]) -> List[Any]:
+        """Analyze articles with bounded concurrency; results (or exceptions) keep input order"""
+        def analyze(article: Dict[str, str]) -> Any:
+            try:
+                return self.analyze_article(article['url'], article.get('headline', ''))
+            except Exception as e:
+                return e
+        
+        if not articles:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.ANALYZE_CONCURRENCY, len(articles))) as executor:
+            return list(executor.map(analyze, articles))
     
     def run(self) -> Dict[str, Any]:
         """
@@ -297,24 +342,37 @@ class NewsPipeline:
             
             logger.info(f"Processing {len(articles)} articles...")
             
-            # Step 2 & 3: Check duplicates and analyze new articles
+            # Step 2: Check duplicates for all fetched URLs at once
+            existing_urls = self.find_existing_urls(
+                list({article['url'] for article in articles if article.get('url')}))
+            
+            # Step 3: Analyze new articles concurrently
+            new_articles = []
             for article in articles:
                 url = article.get('url')
-                headline = article.get('headline', '')
                 
                 if not url:
                     continue
                 
+                # Check if duplicate
+                if url in existing_urls:
+                    logger.info(f"Skipping duplicate article: {url}")
+                    continue
+                existing_urls.add(url)
+                new_articles.append(article)
+            
+            stats["new_articles"] = len(new_articles)
+            results = self._analyze_all(new_articles)
+            
+            # Step 4: Collect analyzed articles and save them in batches
+            pending = []
+            for article, analysis in zip(new_articles, results):
+                url = article['url']
+                headline = article.get('headline', '')
+                
                 try:
-                    # Check if duplicate
-                    if self.check_duplicate(url):
-                        logger.info(f"Skipping duplicate article: {url}")
-                        continue
-                    
-                    stats["new_articles"] += 1
-                    
-                    # Analyze article
-                    analysis = self.analyze_article(url, headline)
+                    if isinstance(analysis, Exception):
+                        raise analysis
                     
                     if analysis:
                         stats["analyzed"] += 1
@@ -324,9 +382,7 @@ class NewsPipeline:
                         if not analysis.get('headline'):
                             analysis['headline'] = headline
                         
-                        # Save to Firestore
-                        if self.save_to_firestore(analysis):
-                            stats["saved"] += 1
+                        pending.append(analysis)
                     else:
                         stats["errors"] += 1
                         logger.error(f"Failed to analyze article: {url}")
@@ -336,6 +392,8 @@ class NewsPipeline:
                     logger.error(f"Error processing article {url}: {str(e)}")
                     continue
             
+            stats["saved"] = self.save_to_firestore(pending)
+            
             logger.info(f"Pipeline complete. Stats: {stats}")
             return stats
             
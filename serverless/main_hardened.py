@@ -40,6 +40,9 @@ class SentimentEnum(str, Enum):
     NEUTRAL = "Neutral"
 
 
+# Numeric sentiment stored with each article so analytics can use count()/sum() aggregations
+SENTIMENT_SCORES = {SentimentEnum.POSITIVE: 1, SentimentEnum.NEGATIVE: -1, SentimentEnum.NEUTRAL: 0}
+
 class ArticleModel(BaseModel):
     """Pydantic model for individual article validation"""
     headline: str = Field(..., min_length=1, max_length=500)
@@ -289,9 +292,12 @@ class NewsPipelineHardened:
             
             saved_count = 0
             for article in articles:
+                score = SENTIMENT_SCORES.get(article.get('sentiment'), 0)
+                
                 # Add timestamps
                 article_data = {
                     **article,
+                    "sentimentScore": score,
                     "publishedAt": firestore.SERVER_TIMESTAMP,
                     "processedAt": firestore.SERVER_TIMESTAMP,
                 }
@@ -3,20 +3,23 @@ AI Market Insights - Hardened News Pipeline with Integrated Sentiment Analysis
 Phase 1 + Phase 4 Real-time Sentiment (SRE Audit Fixes)
 """
 
-import json
 import logging
 import re
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional, Set
-from urllib.parse import urlparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Annotated, List, Dict, Any, Literal, NotRequired, Optional, Set, Tuple, TypedDict
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud import secretmanager
 import google.generativeai as genai
 from tenacity import retry, stop_after_attempt, wait_exponential
-from pydantic import BaseModel, Field, validator
-from enum import Enum
+import msgspec
+from msgspec import Meta
+
+from firestore_utils import snapshot_field
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,78 +36,193 @@ db = firestore.client()
 secret_client = secretmanager.SecretManagerServiceClient()
 
 
-class SentimentEnum(str, Enum):
-    """Enum for sentiment values to prevent AI hallucination"""
-    POSITIVE = "Positive"
-    NEGATIVE = "Negative"
-    NEUTRAL = "Neutral"
+# Top Indian financial news sources
+NEWS_SOURCES = [
+    "site:moneycontrol.com",
+    "site:economictimes.indiatimes.com", 
+    "site:livemint.com",
+    "site:business-standard.com",
+    "site:financialexpress.com",
+    "site:thehindubusinessline.com",
+]
 
+# SRE Fix: Sources are split into shards searched by parallel Gemini calls;
+# the per-shard prompts are static, so they are built once at import time
+SOURCE_SHARDS = 3
+_PROMPT_TEMPLATE = """
+        TASK: Find and analyze recent Indian stock market news articles in a single operation.
 
-class ArticleModel(BaseModel):
-    """Pydantic model for individual article validation with sectors"""
-    headline: str = Field(..., min_length=1, max_length=500)
-    source: str = Field(..., min_length=1, max_length=100)
-    url: str = Field(..., regex=r'^https?://.+')
-    summary: str = Field(..., min_length=10, max_length=1000)
-    sentiment: SentimentEnum
-    tickers: List[str] = Field(default_factory=list, max_items=20)
-    sectors: List[str] = Field(default_factory=list, max_items=10)  # SRE Fix: Added sectors
-    
-    @validator('tickers')
-    def validate_tickers(cls, v):
-        """Ensure tickers are uppercase and valid format"""
-        return [ticker.upper().strip() for ticker in v if ticker.strip()]
-    
-    @validator('sectors')
-    def validate_sectors(cls, v):
-        """Ensure sectors are valid and unique"""
-        valid_sectors = {
-            "IT", "Banking", "Pharma", "Auto", "FMCG", 
-            "Energy", "Metals", "Real Estate", "Telecom", "Power"
-        }
-        return list(set([sector.strip() for sector in v if sector.strip() in valid_sectors]))
+        STEP 1 - SEARCH: Find recent articles published in the last 15-20 minutes from these sources:
+        {sources_query}
+        
+        Focus on articles about:
+        - Stock market news and analysis
+        - Company earnings and quarterly results
+        - Economic indicators and policy changes
+        - Sector-specific news (banking, IT, pharma, auto, FMCG, energy)
+        - Corporate announcements and mergers
+        - Market trends and predictions
+        - IPOs and new listings
 
+        STEP 2 - ANALYSIS: For each article found, perform comprehensive analysis:
+        1. Extract the headline and identify the news source
+        2. Read the full article content
+        3. Write a concise 1-2 sentence summary highlighting key financial/economic impact
+        4. Determine sentiment: "Positive" (bullish/good for markets), "Negative" (bearish/bad for markets), or "Neutral" (mixed/no clear impact)
+        5. Extract relevant Indian stock ticker symbols in UPPERCASE (e.g., ["RELIANCE", "TCS", "HDFCBANK"])
+        6. Identify relevant sectors from: IT, Banking, Pharma, Auto, FMCG, Energy, Metals, Real Estate, Telecom, Power
 
-class ArticleListModel(BaseModel):
-    """Pydantic model for the complete response validation"""
-    articles: List[ArticleModel] = Field(..., min_items=0, max_items=50)
+        OUTPUT FORMAT: Return ONLY a valid JSON object with this exact structure:
+        {{
+            "articles": [
+                {{
+                    "headline": "Article headline here",
+                    "source": "Source name (e.g., Moneycontrol, The Economic Times)",
+                    "url": "https://article-url.com",
+                    "summary": "Concise 1-2 sentence summary of key impact",
+                    "sentiment": "Positive" | "Negative" | "Neutral",
+                    "tickers": ["RELIANCE", "TCS"] // Array of ticker symbols in UPPERCASE, empty array [] if none
+                    "sectors": ["Energy", "IT"] // Array of relevant sectors, empty array [] if none
+                }}
+            ]
+        }}
+
+        REQUIREMENTS:
+        - Return ONLY JSON, no additional text
+        - Maximum 30 articles to avoid rate limits
+        - Ensure all required fields are present
+        - Use exact sentiment values: "Positive", "Negative", or "Neutral"
+        - Ticker symbols must be in UPPERCASE
+        - Sectors must be from the predefined list
+        - Skip duplicate articles if found
+        """
+_SHARD_PROMPTS = [
+    _PROMPT_TEMPLATE.format(sources_query=" OR ".join(f'"{src}"' for src in NEWS_SOURCES[i::SOURCE_SHARDS]))
+    for i in range(SOURCE_SHARDS)
+]
+
+# Gemini key and model are reused by warm instances (each request builds a new pipeline)
+API_KEY_TTL = 3600  # re-fetch hourly so rotated secrets are picked up
+_api_key_cache: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
+_model_cache: Dict[str, Any] = {"model": None, "api_key": None}
+_model_lock = threading.Lock()
+
+
+def _get_model(api_key: str):
+    """Module-wide Gemini model, rebuilt only when the API key changes"""
+    with _model_lock:
+        if _model_cache["model"] is not None and _model_cache["api_key"] == api_key:
+            return _model_cache["model"]
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(
+            'gemini-2.0-flash-exp',
+            tools=[{"google_search": {}}]
+        )
+        _model_cache.update(model=model, api_key=api_key)
+        return model
+
+
+VALID_SECTORS = frozenset([
+    "IT", "Banking", "Pharma", "Auto", "FMCG", 
+    "Energy", "Metals", "Real Estate", "Telecom", "Power"
+])
+
+# Real-time sentiment window; previous totals are reused when recent enough
+SENTIMENT_WINDOW = timedelta(hours=6)
+INCREMENTAL_MAX_GAP = timedelta(minutes=30)
+# Incremental totals are rebuilt from a full window read at least this often
+REBASELINE_INTERVAL = timedelta(hours=1)
+
+# Markdown code fence around the JSON payload, if the model adds one
+_JSON_BLOCK_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+
+# Sentiment label -> score; lowercase keys tolerate legacy documents
+_SENTIMENT_SCORES = {
+    "Positive": 1, "Negative": -1, "Neutral": 0,
+    "positive": 1, "negative": -1, "neutral": 0,
+}
+
+
+class ArticleModel(TypedDict):
+    """msgspec schema for individual article validation with sectors (decodes to a plain dict)"""
+    headline: Annotated[str, Meta(min_length=1, max_length=500)]
+    source: Annotated[str, Meta(min_length=1, max_length=100)]
+    url: str
+    summary: Annotated[str, Meta(min_length=10, max_length=1000)]
+    # Literal prevents AI hallucinated sentiment values
+    sentiment: Literal["Positive", "Negative", "Neutral"]
+    tickers: NotRequired[Annotated[List[str], Meta(max_length=20)]]
+    sectors: NotRequired[Annotated[List[str], Meta(max_length=10)]]  # SRE Fix: Added sectors
+
+
+class ArticleListModel(TypedDict):
+    """msgspec schema for the complete response validation"""
+    articles: Annotated[List[ArticleModel], Meta(max_length=50)]
+
+
+def _decode_articles(data: bytes) -> List[Dict[str, Any]]:
+    """
+    Parse and validate the response in one pass. On malformed JSON, retry
+    once on the outermost {...} span so leading/trailing chatter from the
+    model does not discard an otherwise valid payload
+    """
+    try:
+        return msgspec.json.decode(data, type=ArticleListModel)['articles']
+    except msgspec.ValidationError:
+        raise
+    except msgspec.DecodeError:
+        start, end = data.find(b'{'), data.rfind(b'}') + 1
+        if start < 0 or end <= start or (start, end) == (0, len(data)):
+            raise
+        return msgspec.json.decode(data[start:end], type=ArticleListModel)['articles']
+
+
+def _normalize_article(article: Dict[str, Any]) -> None:
+    """
+    Checks msgspec cannot express, applied in place on the decoded dict:
+    URL scheme, uppercase tickers, valid and unique sectors
+    """
+    url = article['url']
+    # Prefix test instead of a regex; the host part must be non-empty
+    if not ((url.startswith('https://') and len(url) > 8)
+            or (url.startswith('http://') and len(url) > 7)):
+        raise msgspec.ValidationError(f"invalid url: {url[:100]}")
+    article['tickers'] = [ticker.upper().strip() for ticker in article.get('tickers', ()) if ticker.strip()]
+    # dict.fromkeys dedupes while keeping the model's sector order
+    article['sectors'] = list(dict.fromkeys(
+        sector for sector in map(str.strip, article.get('sectors', ())) if sector in VALID_SECTORS))
 
 
 class NewsPipelineHardenedWithSentiment:
     """
     Hardened news pipeline with integrated sentiment analysis:
-    1. Single Gemini API call (cost optimization)
+    1. One combined search+analysis Gemini call per source shard (3), run concurrently
     2. Batch duplicate checking (N+1 query fix)
-    3. Pydantic validation (data integrity)
+    3. msgspec validation (data integrity)
     4. Secret Manager integration (security)
     5. Concurrency control (race condition prevention)
     6. Integrated real-time sentiment calculation (SRE Fix)
     """
     
-    # Top Indian financial news sources
-    NEWS_SOURCES = [
-        "site:moneycontrol.com",
-        "site:economictimes.indiatimes.com", 
-        "site:livemint.com",
-        "site:business-standard.com",
-        "site:financialexpress.com",
-        "site:thehindubusinessline.com",
-    ]
+    NEWS_SOURCES = NEWS_SOURCES
     
     def __init__(self):
         self.project_id = self._get_project_id()
         self.gemini_api_key = self._get_gemini_api_key()
         
         # Configure Gemini with single model for both search and analysis
-        genai.configure(api_key=self.gemini_api_key)
-        self.model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            tools=[{"google_search": {}}]
-        )
+        self.model = _get_model(self.gemini_api_key)
         
         # Cache for existing URLs to avoid N+1 queries
         self.existing_urls: Set[str] = set()
         
+        # Single reference "now" for every time window in a run (set by run())
+        self._now: Optional[datetime] = None
+        
+    def _reference_now(self) -> datetime:
+        """The run's reference time, or the current time outside run()"""
+        return self._now or datetime.utcnow()
+    
     def _get_project_id(self) -> str:
         """Get GCP project ID from environment"""
         import os
@@ -114,14 +232,19 @@ class NewsPipelineHardenedWithSentiment:
         return project_id
     
     def _get_gemini_api_key(self) -> str:
-        """Retrieve Gemini API key from Secret Manager"""
+        """Retrieve Gemini API key from Secret Manager (cached for API_KEY_TTL)"""
+        now = time.monotonic()
+        if _api_key_cache["value"] and now - _api_key_cache["fetched_at"] < API_KEY_TTL:
+            return _api_key_cache["value"]
         try:
             secret_name = f"projects/{self.project_id}/secrets/gemini-api-key/versions/latest"
             response = secret_client.access_secret_version(request={"name": secret_name})
-            return response.payload.data.decode("UTF-8")
+            key = response.payload.data.decode("UTF-8")
         except Exception as e:
             logger.error(f"Error retrieving Gemini API key: {str(e)}")
             raise ValueError("Failed to retrieve Gemini API key from Secret Manager")
+        _api_key_cache.update(value=key, fetched_at=now)
+        return key
     
     def _load_existing_urls(self) -> None:
         """
@@ -131,12 +254,17 @@ class NewsPipelineHardenedWithSentiment:
             logger.info("Loading existing URLs from last 24 hours...")
             
             # Query articles from last 24 hours
-            cutoff_time = datetime.utcnow() - timedelta(hours=24)
+            cutoff_time = self._reference_now() - timedelta(hours=24)
             articles_ref = db.collection('articles')
             query = articles_ref.where('publishedAt', '>=', cutoff_time).select(['url'])
             
-            docs = query.stream()
-            self.existing_urls = {doc.to_dict()['url'] for doc in docs if 'url' in doc.to_dict()}
+            # Read the projected url field directly; no per-row dict
+            existing_urls = set()
+            for doc in query.stream():
+                url = snapshot_field(doc, 'url')
+                if url:
+                    existing_urls.add(url)
+            self.existing_urls = existing_urls
             
             logger.info(f"Loaded {len(self.existing_urls)} existing URLs from last 24 hours")
             
@@ -144,74 +272,44 @@ class NewsPipelineHardenedWithSentiment:
             logger.error(f"Error loading existing URLs: {str(e)}")
             self.existing_urls = set()
     
-    def _build_combined_prompt(self) -> str:
+    def _build_combined_prompt(self, shard: int) -> str:
+        """
+        SRE Fix #1: Single combined prompt for search + analysis + sectors (one per source shard)
+        """
+        return _SHARD_PROMPTS[shard]
+    
+    def fetch_and_analyze_articles(self) -> List[Dict[str, Any]]:
         """
-        SRE Fix #1: Single combined prompt for search + analysis + sectors
+        SRE Fix #1: Combined search + analysis, one API call per source shard in parallel
+        Shards that fail are skipped; the run only fails if every shard does
         """
-        sources_query = " OR ".join([f'"{src}"' for src in self.NEWS_SOURCES])
+        logger.info(f"Starting combined search and analysis across {SOURCE_SHARDS} source shards...")
         
-        prompt = f"""
-        TASK: Find and analyze recent Indian stock market news articles in a single operation.
-
-        STEP 1 - SEARCH: Find recent articles published in the last 15-20 minutes from these sources:
-        {sources_query}
+        with ThreadPoolExecutor(max_workers=SOURCE_SHARDS) as executor:
+            futures = [executor.submit(self._fetch_shard, shard) for shard in range(SOURCE_SHARDS)]
         
-        Focus on articles about:
-        - Stock market news and analysis
-        - Company earnings and quarterly results
-        - Economic indicators and policy changes
-        - Sector-specific news (banking, IT, pharma, auto, FMCG, energy)
-        - Corporate announcements and mergers
-        - Market trends and predictions
-        - IPOs and new listings
-
-        STEP 2 - ANALYSIS: For each article found, perform comprehensive analysis:
-        1. Extract the headline and identify the news source
-        2. Read the full article content
-        3. Write a concise 1-2 sentence summary highlighting key financial/economic impact
-        4. Determine sentiment: "Positive" (bullish/good for markets), "Negative" (bearish/bad for markets), or "Neutral" (mixed/no clear impact)
-        5. Extract relevant Indian stock ticker symbols in UPPERCASE (e.g., ["RELIANCE", "TCS", "HDFCBANK"])
-        6. Identify relevant sectors from: IT, Banking, Pharma, Auto, FMCG, Energy, Metals, Real Estate, Telecom, Power
-
-        OUTPUT FORMAT: Return ONLY a valid JSON object with this exact structure:
-        {{
-            "articles": [
-                {{
-                    "headline": "Article headline here",
-                    "source": "Source name (e.g., Moneycontrol, The Economic Times)",
-                    "url": "https://article-url.com",
-                    "summary": "Concise 1-2 sentence summary of key impact",
-                    "sentiment": "Positive" | "Negative" | "Neutral",
-                    "tickers": ["RELIANCE", "TCS"] // Array of ticker symbols in UPPERCASE, empty array [] if none
-                    "sectors": ["Energy", "IT"] // Array of relevant sectors, empty array [] if none
-                }}
-            ]
-        }}
-
-        REQUIREMENTS:
-        - Return ONLY JSON, no additional text
-        - Maximum 30 articles to avoid rate limits
-        - Ensure all required fields are present
-        - Use exact sentiment values: "Positive", "Negative", or "Neutral"
-        - Ticker symbols must be in UPPERCASE
-        - Sectors must be from the predefined list
-        - Skip duplicate articles if found
-        """
+        # Merge shard results, deduplicating by URL
+        merged: Dict[str, Dict[str, Any]] = {}
+        errors = []
+        for future in futures:
+            try:
+                for article in future.result():
+                    merged.setdefault(article['url'], article)
+            except Exception as e:
+                errors.append(e)
         
-        return prompt
+        if len(errors) == SOURCE_SHARDS:
+            raise errors[0]
+        return list(merged.values())
     
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(multiplier=1, min=2, max=10)
     )
-    def fetch_and_analyze_articles(self) -> List[Dict[str, Any]]:
-        """
-        SRE Fix #1: Single API call for both search and analysis
-        """
+    def _fetch_shard(self, shard: int) -> List[Dict[str, Any]]:
+        """Single API call for both search and analysis over one source shard"""
         try:
-            logger.info("Starting combined search and analysis operation...")
-            
-            prompt = self._build_combined_prompt()
+            prompt = self._build_combined_prompt(shard)
             
             response = self.model.generate_content(
                 prompt,
@@ -222,45 +320,52 @@ class NewsPipelineHardenedWithSentiment:
                 }
             )
             
-            logger.info("Received response from Gemini, parsing and validating...")
+            logger.info(f"Received response from Gemini for shard {shard}, parsing and validating...")
             return self._parse_and_validate_response(response.text)
             
         except Exception as e:
-            logger.error(f"Error in combined fetch and analyze: {str(e)}")
+            logger.error(f"Error in combined fetch and analyze (shard {shard}): {str(e)}")
             raise
     
     def _parse_and_validate_response(self, response_text: str) -> List[Dict[str, Any]]:
         """
-        SRE Fix #3: Robust validation using Pydantic models
+        SRE Fix #3: Robust validation using msgspec models
+        JSON parsing and validation happen in a single C pass
         """
         try:
             # Clean response text
             response_text = response_text.strip()
             
             # Extract JSON from markdown code blocks if present
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                response_text = json_match.group(1)
+            if "```" in response_text:
+                json_match = _JSON_BLOCK_RE.search(response_text)
+                if json_match:
+                    response_text = json_match.group(1)
             
-            # Parse JSON
-            raw_data = json.loads(response_text)
+            # Parse and validate in one step
+            # Decoding into TypedDicts yields plain dicts, ready for Firestore
+            decoded = _decode_articles(response_text.encode())
             
-            # Validate using Pydantic models
-            validated_data = ArticleListModel(**raw_data)
-            
-            # Convert back to dict for processing
-            articles = [article.dict() for article in validated_data.articles]
+            # Drop repeats within the response before the per-article work
+            seen: Set[str] = set()
+            articles = []
+            for article in decoded:
+                if article['url'] not in seen:
+                    seen.add(article['url'])
+                    articles.append(article)
+            for article in articles:
+                _normalize_article(article)
             
             logger.info(f"Successfully validated {len(articles)} articles")
             return articles
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing failed: {str(e)}")
+        except msgspec.ValidationError as e:
+            logger.error(f"Validation failed: {str(e)}")
             logger.error(f"Raw response: {response_text[:500]}...")
             return []
             
-        except Exception as e:
-            logger.error(f"Pydantic validation failed: {str(e)}")
+        except msgspec.DecodeError as e:
+            logger.error(f"JSON parsing failed: {str(e)}")
             logger.error(f"Raw response: {response_text[:500]}...")
             return []
     
@@ -268,17 +373,20 @@ class NewsPipelineHardenedWithSentiment:
         """
         SRE Fix #2: Efficient duplicate filtering using in-memory set
         """
-        new_articles = []
+        existing = self.existing_urls
+        new_articles = [a for a in articles if (url := a.get('url')) and url not in existing]
         
-        for article in articles:
-            url = article.get('url')
-            if url and url not in self.existing_urls:
-                new_articles.append(article)
-                logger.info(f"New article found: {article.get('headline', 'No headline')}")
-            else:
-                logger.info(f"Skipping duplicate article: {url}")
+        # Per-article detail only at DEBUG; the level check skips the loop entirely otherwise
+        if logger.isEnabledFor(logging.DEBUG):
+            for article in articles:
+                url = article.get('url')
+                if url and url not in existing:
+                    logger.debug("New article: %s", article.get('headline') or 'n/a')
+                else:
+                    logger.debug("Skipping duplicate article: %s", url)
         
-        logger.info(f"Filtered to {len(new_articles)} new articles from {len(articles)} total")
+        logger.info(f"Filtered to {len(new_articles)} new articles from {len(articles)} total "
+                    f"({len(articles) - len(new_articles)} duplicates)")
         return new_articles
     
     def _batch_save_articles(self, articles: List[Dict[str, Any]]) -> int:
@@ -291,26 +399,39 @@ class NewsPipelineHardenedWithSentiment:
         try:
             logger.info(f"Batch saving {len(articles)} articles to Firestore...")
             
-            # Prepare batch write
-            batch = db.batch()
+            # SRE Fix: BulkWriter chunks at the 500-op limit, commits batches in
+            # parallel and retries failed writes with backoff
+            writer = db.bulk_writer()
             articles_ref = db.collection('articles')
             
-            saved_count = 0
+            # Only count writes Firestore acknowledged (BulkWriter is not
+            # atomic); callbacks may run on the writer's worker threads
+            acknowledged = {"count": 0}
+            lock = threading.Lock()
+            
+            def on_write_result(reference, result, bulk_writer):
+                with lock:
+                    acknowledged["count"] += 1
+            
+            writer.on_write_result(on_write_result)
+            
             for article in articles:
+                score = self._sentiment_to_score(article.get('sentiment', 'Neutral'))
+                
                 # Add timestamps
                 article_data = {
                     **article,
+                    "sentimentScore": score,
                     "publishedAt": firestore.SERVER_TIMESTAMP,
                     "processedAt": firestore.SERVER_TIMESTAMP,
                 }
                 
-                # Add to batch
                 doc_ref = articles_ref.document()
-                batch.set(doc_ref, article_data)
-                saved_count += 1
+                writer.create(doc_ref, article_data)
             
-            # Commit batch
-            batch.commit()
+            # Flush and wait for every write
+            writer.close()
+            saved_count = acknowledged["count"]
             
             logger.info(f"Successfully saved {saved_count} articles to Firestore")
             return saved_count
@@ -320,14 +441,24 @@ class NewsPipelineHardenedWithSentiment:
             return 0
     
     def _sentiment_to_score(self, sentiment: str) -> int:
-        """Convert sentiment string to numerical score"""
-        sentiment_lower = sentiment.lower()
-        if sentiment_lower == "positive":
-            return 1
-        elif sentiment_lower == "negative":
-            return -1
-        else:  # neutral or unknown
-            return 0
+        """Convert sentiment string to numerical score (neutral or unknown -> 0)"""
+        return _SENTIMENT_SCORES.get(sentiment, 0)
+    
+    def _sum_scores(self, start: datetime, end: datetime) -> Tuple[int, int]:
+        """Sentiment score sum and article count for publishedAt in [start, end)"""
+        # Projection: only the sentiment field crosses the wire
+        query = (db.collection('articles')
+                .where('publishedAt', '>=', start)
+                .where('publishedAt', '<', end)
+                .select(['sentiment']))
+        
+        # Running sum/count: only two scalars are needed, not every article
+        score_sum = 0
+        article_count = 0
+        for doc in query.stream():
+            score_sum += self._sentiment_to_score(snapshot_field(doc, 'sentiment', 'Neutral'))
+            article_count += 1
+        return score_sum, article_count
     
     def calculate_and_save_real_time_sentiment(self) -> Dict[str, Any]:
         """
@@ -337,49 +468,61 @@ class NewsPipelineHardenedWithSentiment:
         try:
             logger.info("Calculating real-time sentiment from last 6 hours...")
             
-            # Calculate 6-hour rolling window
-            end_time = datetime.utcnow()
-            start_time = end_time - timedelta(hours=6)
-            
-            # Query articles in the timeframe
-            articles_ref = db.collection('articles')
-            query = articles_ref.where('publishedAt', '>=', start_time).where('publishedAt', '<=', end_time)
-            
-            docs = query.stream()
-            articles = []
-            
-            for doc in docs:
-                article_data = doc.to_dict()
-                articles.append(article_data)
+            # Window ends now (not at the run's reference time) so articles
+            # saved earlier in this run, stamped by the server, are included
+            window_end = datetime.now(timezone.utc)
+            window_start = window_end - SENTIMENT_WINDOW
+            doc_ref = db.collection('market_status').document('current_sentiment')
             
-            if not articles:
+            # SRE Fix: Incremental window. Reuse the previous run's totals and
+            # only read the articles that entered or left the window since then
+            snapshot = doc_ref.get()
+            previous = snapshot.to_dict() if snapshot.exists else None
+            totals = None
+            # A write committed with publishedAt just below the previous windowEnd
+            # but not yet visible to that run is never added, yet still subtracted
+            # when it expires; re-baselining whenever windowEnd crosses a
+            # REBASELINE_INTERVAL boundary keeps that drift from accumulating
+            if previous and previous.get('windowEnd') and 'scoreSum' in previous:
+                gap = window_end - previous['windowEnd']
+                same_interval = (previous['windowEnd'].timestamp() // REBASELINE_INTERVAL.total_seconds()
+                                 == window_end.timestamp() // REBASELINE_INTERVAL.total_seconds())
+                if timedelta(0) <= gap <= INCREMENTAL_MAX_GAP and same_interval:
+                    added_sum, added_count = self._sum_scores(previous['windowEnd'], window_end)
+                    expired_sum, expired_count = self._sum_scores(
+                        previous['windowEnd'] - SENTIMENT_WINDOW, window_start)
+                    totals = (previous['scoreSum'] + added_sum - expired_sum,
+                              previous.get('articlesAnalyzed', 0) + added_count - expired_count)
+            
+            # Full recompute: no usable previous state (missing, stale or inconsistent)
+            if totals is None or totals[1] < 0:
+                totals = self._sum_scores(window_start, window_end)
+            score_sum, article_count = totals
+            
+            if article_count == 0:
                 logger.warning("No articles found in 6-hour window, defaulting to neutral")
                 sentiment_data = {
                     "averageScore": 0.0,
                     "lastUpdated": firestore.SERVER_TIMESTAMP,
                     "articlesAnalyzed": 0,
-                    "timeWindow": "6 hours"
+                    "timeWindow": "6 hours",
+                    "scoreSum": 0,
+                    "windowEnd": window_end
                 }
             else:
-                # Calculate sentiment scores
-                sentiment_scores = []
-                for article in articles:
-                    sentiment = article.get('sentiment', 'Neutral')
-                    score = self._sentiment_to_score(sentiment)
-                    sentiment_scores.append(score)
-                
                 # Calculate average
-                average_score = sum(sentiment_scores) / len(sentiment_scores)
+                average_score = score_sum / article_count
                 
                 sentiment_data = {
                     "averageScore": round(average_score, 3),
                     "lastUpdated": firestore.SERVER_TIMESTAMP,
-                    "articlesAnalyzed": len(articles),
-                    "timeWindow": "6 hours"
+                    "articlesAnalyzed": article_count,
+                    "timeWindow": "6 hours",
+                    "scoreSum": score_sum,
+                    "windowEnd": window_end
                 }
             
             # Save to market_status collection
-            doc_ref = db.collection('market_status').document('current_sentiment')
             doc_ref.set(sentiment_data)
             
             logger.info(f"Real-time sentiment calculated and saved: {sentiment_data['averageScore']}")
@@ -410,15 +553,18 @@ class NewsPipelineHardenedWithSentiment:
         }
         
         start_time = datetime.utcnow()
+        self._now = start_time
         
         try:
             logger.info("Starting hardened news pipeline with integrated sentiment...")
             
-            # Step 1: Load existing URLs to avoid N+1 queries
-            self._load_existing_urls()
-            
-            # Step 2: Single API call for search + analysis
-            articles = self.fetch_and_analyze_articles()
+            # Steps 1 & 2 are independent, so overlap the URL load (Firestore)
+            # with the single search + analysis API call (Gemini)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                urls_future = executor.submit(self._load_existing_urls)
+                articles_future = executor.submit(self.fetch_and_analyze_articles)
+                urls_future.result()
+                articles = articles_future.result()
             stats["fetched"] = len(articles)
             
             if not articles:
@@ -472,7 +618,7 @@ def news_pipeline_hardened_with_sentiment(request):
     
     return {
         'statusCode': 200,
-        'body': json.dumps(stats)
+        'body': msgspec.json.encode(stats).decode()
     }
 
 
@@ -3,18 +3,22 @@ AI Market Insights - Market Data API Proxy
 Secure proxy to third-party financial data APIs with caching
 """
 
+import hashlib
 import json
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Union
 import time
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud import secretmanager
-import requests
-from flask import Flask, request, jsonify
+import redis
+import httpx
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
 # Configure logging
@@ -40,6 +44,38 @@ CACHE_DURATION_MINUTES = 5
 CACHE_COLLECTION = "market_data_cache"
 CACHE_DOCUMENT_ID = "latest_data"
 
+# Redis cache configuration (Memorystore); Firestore is used when unset
+REDIS_HOST = os.environ.get("REDIS_HOST", "")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", "")
+CACHE_KEY = "market_data"
+
+# In-process copy of the cached response body (serialized JSON); warm instances
+# skip the Redis/Firestore read and the JSON encode
+_LOCAL_CACHE = {"body": None, "expires_at": 0.0}
+
+# Secret Manager key shared by every MarketDataAPI in the process; keys rotate rarely
+API_KEY_TTL = 24 * 3600
+_api_key_cache: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
+_api_key_lock = threading.Lock()
+
+# HTTP client configuration: 3s to connect, 10s for everything else
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+# Alpha Vantage endpoints and the index quotes fetched on each refresh
+QUOTE_URL = "https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={api_key}"
+MOVERS_URL = "https://www.alphavantage.co/query?function=TOP_GAINERS_LOSERS&apikey={api_key}"
+MOVERS_LIMIT = 5
+# GLOBAL_QUOTE fields read from each quote
+QUOTE_PRICE = "05. price"
+QUOTE_CHANGE = "09. change"
+QUOTE_CHANGE_PERCENT = "10. change percent"
+# (provider symbol, display name)
+INDEX_SYMBOLS = (
+    ("^NSEI", "NIFTY 50"),
+    ("^BSESN", "SENSEX"),
+)
+
 
 class MarketDataAPI:
     """Main class for fetching and caching market data"""
@@ -47,20 +83,90 @@ class MarketDataAPI:
     def __init__(self):
         self.secret_client = secretmanager.SecretManagerServiceClient()
         self.project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+        self.http = self._create_http_client()
+        self.redis_client = self._initialize_redis()
+        
+    def _initialize_redis(self) -> Optional[redis.Redis]:
+        """Connect to Redis if configured, otherwise fall back to the Firestore cache"""
+        if not REDIS_HOST:
+            return None
         
-    def _get_api_key(self) -> str:
-        """Retrieve API key from Secret Manager"""
         try:
-            secret_name = f"projects/{self.project_id}/secrets/financial-api-key/versions/latest"
-            response = self.secret_client.access_secret_version(request={"name": secret_name})
-            return response.payload.data.decode("UTF-8")
+            redis_client = redis.Redis(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                password=REDIS_PASSWORD if REDIS_PASSWORD else None,
+                socket_timeout=5,
+                socket_connect_timeout=5,
+                retry_on_timeout=True,
+                health_check_interval=30
+            )
+            
+            # Test connection
+            redis_client.ping()
+            logger.info("Redis connection established successfully")
+            return redis_client
+            
         except Exception as e:
-            logger.error(f"Error retrieving API key: {str(e)}")
-            # Fallback to environment variable
-            return os.environ.get("FINANCIAL_API_KEY", "")
+            logger.error(f"Failed to initialize Redis: {str(e)}")
+            logger.warning("Falling back to Firestore cache")
+            return None
+        
+    def _create_http_client(self) -> httpx.Client:
+        """Pooled HTTP/2 client so concurrent calls to the data provider share one TLS connection"""
+        # Pool limits and HTTP/2 are transport settings once a transport is supplied
+        transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            retries=2  # Retries failed connects
+        )
+        return httpx.Client(transport=transport, timeout=HTTP_TIMEOUT)
+        
+    def _get_api_key(self) -> str:
+        """Retrieve API key from Secret Manager (cached process-wide for API_KEY_TTL)"""
+        # Lock so concurrent cache misses make a single Secret Manager call
+        with _api_key_lock:
+            now = time.monotonic()
+            if _api_key_cache["value"] and now - _api_key_cache["fetched_at"] < API_KEY_TTL:
+                return _api_key_cache["value"]
+            
+            try:
+                secret_name = f"projects/{self.project_id}/secrets/financial-api-key/versions/latest"
+                response = self.secret_client.access_secret_version(request={"name": secret_name})
+                api_key = response.payload.data.decode("UTF-8")
+                _api_key_cache.update(value=api_key, fetched_at=now)
+                return api_key
+            except Exception as e:
+                logger.error(f"Error retrieving API key: {str(e)}")
+                # Fallback to environment variable (not cached, so Secret Manager is retried)
+                return os.environ.get("FINANCIAL_API_KEY", "")
     
-    def _get_cached_data(self) -> Optional[Dict[str, Any]]:
-        """Retrieve cached market data from Firestore"""
+    def _get_cached_data(self) -> Optional[bytes]:
+        """
+        Retrieve cached market data as serialized JSON from memory, then Redis
+        (or Firestore without Redis)
+        """
+        if time.monotonic() < _LOCAL_CACHE["expires_at"]:
+            logger.info("Returning in-memory cached data")
+            return _LOCAL_CACHE["body"]
+        
+        if self.redis_client:
+            try:
+                # One round trip for the payload and its remaining TTL
+                cached_data, ttl = self.redis_client.pipeline().get(CACHE_KEY).ttl(CACHE_KEY).execute()
+                if not cached_data:
+                    logger.info("Cache miss, will fetch new data")
+                    return None
+                
+                logger.info("Returning cached data from Redis")
+                _LOCAL_CACHE["body"] = cached_data
+                _LOCAL_CACHE["expires_at"] = time.monotonic() + max(ttl, 0)
+                return cached_data
+                
+            except Exception as e:
+                logger.error(f"Error retrieving from Redis cache: {str(e)}")
+                # Fall through to the Firestore cache
+        
         try:
             doc_ref = db.collection(CACHE_COLLECTION).document(CACHE_DOCUMENT_ID)
             doc = doc_ref.get()
@@ -74,9 +180,14 @@ class MarketDataAPI:
                     cache_time = cached_at.replace(tzinfo=None)
                     now = datetime.utcnow()
                     
-                    if (now - cache_time).total_seconds() < (CACHE_DURATION_MINUTES * 60):
+                    remaining = CACHE_DURATION_MINUTES * 60 - (now - cache_time).total_seconds()
+                    
+                    if remaining > 0:
                         logger.info("Returning cached data")
-                        return data.get("market_data")
+                        # Keep it in memory, serialized once, for the rest of its TTL
+                        _LOCAL_CACHE["body"] = json.dumps(data.get("market_data")).encode()
+                        _LOCAL_CACHE["expires_at"] = time.monotonic() + remaining
+                        return _LOCAL_CACHE["body"]
                     else:
                         logger.info("Cache expired, will fetch new data")
                         return None
@@ -88,7 +199,18 @@ class MarketDataAPI:
             return None
     
     def _save_cached_data(self, market_data: Dict[str, Any]) -> bool:
-        """Save market data to Firestore cache"""
+        """Save market data to the in-memory, Redis and Firestore caches"""
+        body = json.dumps(market_data).encode()
+        _LOCAL_CACHE["body"] = body
+        _LOCAL_CACHE["expires_at"] = time.monotonic() + CACHE_DURATION_MINUTES * 60
+        
+        if self.redis_client:
+            try:
+                self.redis_client.setex(CACHE_KEY, CACHE_DURATION_MINUTES * 60, body)
+            except Exception as e:
+                logger.error(f"Error saving to Redis cache: {str(e)}")
+        
+        # Firestore copy never expires: it backs the stale fallback on cold starts
         try:
             doc_ref = db.collection(CACHE_COLLECTION).document(CACHE_DOCUMENT_ID)
             doc_ref.set({
@@ -104,93 +226,59 @@ class MarketDataAPI:
             logger.error(f"Error saving cached data: {str(e)}")
             return False
     
-    def _fetch_index_data(self, api_key: str) -> List[Dict[str, Any]]:
-        """Fetch NIFTY 50 and SENSEX data"""
-        indices = []
-        
-        # NIFTY 50 (^NSEI)
+    def _fetch_single_quote(self, symbol: str, name: str, api_key: str) -> Optional[Dict[str, Any]]:
+        """Fetch a single index quote (e.g. ^NSEI for NIFTY 50)"""
         try:
-            url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^NSEI&apikey={api_key}"
-            response = requests.get(url, timeout=10)
+            response = self.http.get(QUOTE_URL.format(symbol=symbol, api_key=api_key))
             response.raise_for_status()
             
             data = response.json()
             quote = data.get("Global Quote", {})
             
             if quote:
-                price = float(quote.get("05. price", 0))
-                change = float(quote.get("09. change", 0))
-                change_percent = float(quote.get("10. change percent", "0%").replace("%", ""))
+                price = float(quote.get(QUOTE_PRICE, 0))
+                change = float(quote.get(QUOTE_CHANGE, 0))
+                change_percent = float(quote.get(QUOTE_CHANGE_PERCENT, "0%").rstrip("%") or 0)
                 
-                indices.append({
-                    "name": "NIFTY 50",
+                return {
+                    "name": name,
                     "price": price,
                     "change": change,
                     "changePercent": change_percent
-                })
+                }
                 
         except Exception as e:
-            logger.error(f"Error fetching NIFTY 50 data: {str(e)}")
+            logger.error(f"Error fetching {name} data: {str(e)}")
         
-        # SENSEX (^BSESN)
-        try:
-            url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^BSESN&apikey={api_key}"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            quote = data.get("Global Quote", {})
-            
-            if quote:
-                price = float(quote.get("05. price", 0))
-                change = float(quote.get("09. change", 0))
-                change_percent = float(quote.get("10. change percent", "0%").replace("%", ""))
-                
-                indices.append({
-                    "name": "SENSEX",
-                    "price": price,
-                    "change": change,
-                    "changePercent": change_percent
-                })
-                
-        except Exception as e:
-            logger.error(f"Error fetching SENSEX data: {str(e)}")
-        
-        return indices
+        return None
     
     def _fetch_market_movers(self, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
-        """Fetch top gainers and losers"""
-        gainers = []
-        losers = []
-        
-        # Sample data - replace with actual API calls
-        # In production, you would call APIs like:
-        # - NSE top gainers/losers endpoint
-        # - BSE top gainers/losers endpoint
-        # - Or use a financial data provider
-        
+        """Fetch top gainers and losers with a single bulk request"""
         try:
-            # Mock data for demonstration - replace with actual API calls
-            gainers = [
-                {"ticker": "LT", "name": "Larsen & Toubro", "price": 3500.00, "changePercent": 5.2},
-                {"ticker": "M&M", "name": "Mahindra & Mahindra", "price": 2900.00, "changePercent": 4.8},
-                {"ticker": "RELIANCE", "name": "Reliance Industries", "price": 2450.00, "changePercent": 3.5},
-                {"ticker": "TCS", "name": "Tata Consultancy", "price": 3200.00, "changePercent": 2.8},
-                {"ticker": "HDFCBANK", "name": "HDFC Bank", "price": 1650.00, "changePercent": 2.1}
-            ]
+            # TOP_GAINERS_LOSERS returns both lists at once instead of one quote per ticker
+            response = self.http.get(MOVERS_URL.format(api_key=api_key))
+            response.raise_for_status()
             
-            losers = [
-                {"ticker": "INFY", "name": "Infosys", "price": 1500.00, "changePercent": -1.8},
-                {"ticker": "WIPRO", "name": "Wipro", "price": 420.00, "changePercent": -1.5},
-                {"ticker": "ONGC", "name": "Oil & Natural Gas", "price": 245.00, "changePercent": -1.2},
-                {"ticker": "NTPC", "name": "NTPC", "price": 265.00, "changePercent": -0.9},
-                {"ticker": "COALINDIA", "name": "Coal India", "price": 385.00, "changePercent": -0.7}
-            ]
+            data = response.json()
+            return {
+                "gainers": [self._parse_mover(item) for item in data.get("top_gainers", [])[:MOVERS_LIMIT]],
+                "losers": [self._parse_mover(item) for item in data.get("top_losers", [])[:MOVERS_LIMIT]]
+            }
             
         except Exception as e:
             logger.error(f"Error fetching market movers: {str(e)}")
         
-        return {"gainers": gainers, "losers": losers}
+        return {"gainers": [], "losers": []}
+    
+    @staticmethod
+    def _parse_mover(item: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert one TOP_GAINERS_LOSERS entry to the movers format"""
+        return {
+            "ticker": item["ticker"],
+            "name": item.get("name", item["ticker"]),
+            "price": float(item.get("price", 0)),
+            "changePercent": float(item.get("change_percentage", "0%").rstrip("%") or 0)
+        }
     
     def _fetch_sector_data(self, api_key: str) -> List[Dict[str, Any]]:
         """Fetch sector performance data"""
@@ -224,10 +312,20 @@ class MarketDataAPI:
             
             logger.info("Fetching fresh market data...")
             
-            # Fetch all data components
-            indices = self._fetch_index_data(api_key)
-            movers = self._fetch_market_movers(api_key)
-            sectors = self._fetch_sector_data(api_key)
+            # Fetch all data components - independent network calls run
+            # concurrently and share the pooled HTTP/2 connection
+            with ThreadPoolExecutor(max_workers=len(INDEX_SYMBOLS) + 2) as executor:
+                quote_futures = [
+                    executor.submit(self._fetch_single_quote, symbol, name, api_key)
+                    for symbol, name in INDEX_SYMBOLS
+                ]
+                movers_future = executor.submit(self._fetch_market_movers, api_key)
+                sectors_future = executor.submit(self._fetch_sector_data, api_key)
+                
+                # Keep index order stable regardless of completion order
+                indices = [quote for quote in (f.result() for f in quote_futures) if quote]
+                movers = movers_future.result()
+                sectors = sectors_future.result()
             
             # Aggregate data
             market_data = {
@@ -244,8 +342,8 @@ class MarketDataAPI:
             logger.error(f"Error fetching fresh data: {str(e)}")
             return None
     
-    def get_market_data(self) -> Dict[str, Any]:
-        """Main method to get market data (cached or fresh)"""
+    def get_market_data(self) -> Union[bytes, Dict[str, Any]]:
+        """Main method to get market data (cached JSON bytes or a fresh dict)"""
         # First, try to get cached data
         cached_data = self._get_cached_data()
         
@@ -301,6 +399,14 @@ def get_market_data():
         # Get market data
         data = market_api.get_market_data()
         
+        # Cache hits are already JSON - send them without a decode/encode round trip.
+        # ETag + max-age let browsers/CDNs reuse the body and revalidate with a 304
+        if isinstance(data, bytes):
+            response = Response(data, status=200, mimetype="application/json")
+            response.set_etag(hashlib.md5(data).hexdigest())
+            response.cache_control.max_age = max(int(_LOCAL_CACHE["expires_at"] - time.monotonic()), 0)
+            return response.make_conditional(request)
+        
         return jsonify(data), 200
         
     except Exception as e:
@@ -318,12 +424,9 @@ def market_data_function(request):
     """
     Cloud Function entry point
     """
-    with app.test_request_context(
-        path=request.path,
-        method=request.method,
-        headers=request.headers,
-        data=request.get_data()
-    ):
+    # Dispatch on the incoming WSGI environ directly instead of rebuilding a
+    # test request (which re-parses headers and copies the body)
+    with app.request_context(request.environ):
         return app.full_dispatch_request()
 
 
@@ -3,20 +3,24 @@ AI Market Insights - Hardened Market Data API (SRE Audit Fixes)
 High-performance HTTP proxy with Redis caching, Firebase App Check, and resilience
 """
 
-import json
+import hashlib
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple, Union
 from functools import wraps
 
 import firebase_admin
 from firebase_admin import credentials, firestore, app_check
+from google.auth.transport import requests as google_auth_requests
 from google.cloud import secretmanager
-import requests
+from google.oauth2 import id_token
+import orjson
+import httpx
 import redis
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from tenacity import retry, stop_after_attempt, wait_exponential
 
@@ -44,8 +48,50 @@ CORS(app, origins=[
 REDIS_HOST = os.environ.get("REDIS_HOST", "10.0.0.3")  # Memorystore IP
 REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", "")
-CACHE_TTL_SECONDS = 300  # 5 minutes
-CACHE_KEY = "market_data"
+REDIS_MAX_CONNECTIONS = 32
+# /internal/invalidate drops entries early on a quote update; the TTL still
+# bounds staleness on its own if invalidations stop arriving
+CACHE_TTL_SECONDS = 300
+# Cloud Scheduler calls /internal/invalidate with an OIDC token for this
+# service account, minted for this audience (the function URL); with either
+# unset the endpoint rejects every call
+INVALIDATE_SERVICE_ACCOUNT = os.environ.get("INVALIDATE_SERVICE_ACCOUNT", "")
+INVALIDATE_AUDIENCE = os.environ.get("INVALIDATE_AUDIENCE", "")
+_google_auth_request = google_auth_requests.Request()
+# Market data is cached as independent sections so each can be refreshed or
+# invalidated on its own: Redis key -> market_data fields stored under it
+CACHE_SECTIONS = {
+    "market:indices": ("indices", "lastUpdated", "source"),
+    "market:movers": ("gainers", "losers"),
+    "market:sectors": ("sectors",),
+}
+# Each section also keeps a last-known-good copy without TTL for the stale fallback
+STALE_KEY_SUFFIX = ":stale"
+# Stale data younger than this is served immediately while a background refresh
+# runs; older data makes the caller wait for a synchronous fetch
+STALE_SERVE_SECONDS = 600
+REFRESH_LOCK_KEY = "market:refresh_lock"
+REFRESH_LOCK_SECONDS = 30
+
+# Background revalidation pool shared by all requests on this instance
+_refresh_executor = ThreadPoolExecutor(max_workers=2)
+
+# SRE Fix #4: HTTP client configuration - 3s to connect, 10s for everything else
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+# Alpha Vantage endpoints and the index quotes fetched on each refresh
+QUOTE_URL = "https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={api_key}"
+MOVERS_URL = "https://www.alphavantage.co/query?function=TOP_GAINERS_LOSERS&apikey={api_key}"
+MOVERS_LIMIT = 5
+# GLOBAL_QUOTE fields read from each quote
+QUOTE_PRICE = "05. price"
+QUOTE_CHANGE = "09. change"
+QUOTE_CHANGE_PERCENT = "10. change percent"
+# (provider symbol, display name)
+INDEX_SYMBOLS = (
+    ("^NSEI", "NIFTY 50"),
+    ("^BSESN", "SENSEX"),
+)
 
 
 class MarketDataAPIHardened:
@@ -62,6 +108,9 @@ class MarketDataAPIHardened:
         self.project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
         self.secret_client = secretmanager.SecretManagerServiceClient()
         
+        # Pooled HTTP/2 client: keep-alive reuses the TLS connection across calls
+        self.http = self._create_http_client()
+        
         # SRE Fix #1: Initialize Redis connection
         self.redis_client = self._initialize_redis()
         
@@ -70,19 +119,33 @@ class MarketDataAPIHardened:
         self._api_key_cache_time = 0
         self._api_key_cache_ttl = 300  # 5 minutes
         
+    def _create_http_client(self) -> httpx.Client:
+        """Create an HTTP/2 client; concurrent quote calls multiplex over one connection"""
+        # Pool limits and HTTP/2 are transport settings once a transport is supplied
+        transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            retries=2  # Retries failed connects
+        )
+        return httpx.Client(transport=transport, timeout=HTTP_TIMEOUT)
+    
     def _initialize_redis(self) -> Optional[redis.Redis]:
         """SRE Fix #1: Initialize Redis connection with error handling"""
         try:
-            redis_client = redis.Redis(
+            # Blocking pool: concurrent requests on one instance each get a warm
+            # socket and wait briefly for one instead of opening extra connections
+            pool = redis.BlockingConnectionPool(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 password=REDIS_PASSWORD if REDIS_PASSWORD else None,
-                decode_responses=True,
                 socket_timeout=5,  # SRE Fix #4: Short timeout
                 socket_connect_timeout=5,
                 retry_on_timeout=True,
-                health_check_interval=30
+                health_check_interval=30,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=2  # Max wait for a free connection
             )
+            redis_client = redis.Redis(connection_pool=pool)
             
             # Test connection
             redis_client.ping()
@@ -118,38 +181,77 @@ class MarketDataAPIHardened:
             logger.error(f"Error retrieving API key: {str(e)}")
             raise ValueError("Failed to retrieve API key from Secret Manager")
     
-    def _get_cached_data(self) -> Optional[Dict[str, Any]]:
+    def _read_cache_sections(self) -> Tuple[Optional[bytes], Optional[bytes]]:
+        """
+        Read the fresh and stale copies of every section in one pipelined round trip
+        Each copy is None unless all of its sections are present
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in CACHE_SECTIONS:
+            pipe.get(key)
+        for key in CACHE_SECTIONS:
+            pipe.get(key + STALE_KEY_SUFFIX)
+        results = pipe.execute()
+        
+        section_count = len(CACHE_SECTIONS)
+        return (self._merge_sections(results[:section_count]),
+                self._merge_sections(results[section_count:]))
+    
+    @staticmethod
+    def _merge_sections(sections: List[Optional[bytes]]) -> Optional[bytes]:
+        """
+        Splice serialized sections into one JSON object without decoding them
+        Every section is a non-empty JSON object, so joining their bodies is valid JSON
+        """
+        if not all(sections):
+            return None
+        return b"{" + b",".join(section[1:-1] for section in sections) + b"}"
+    
+    def _get_cached_data(self) -> Tuple[Optional[bytes], Optional[bytes]]:
         """
         SRE Fix #1: High-performance Redis cache retrieval
-        Returns cached data if available, None if cache miss
+        Returns (fresh, stale) cached data as serialized JSON; fresh is None on a
+        cache miss and stale is kept for the fallback so it needs no second Redis call
         """
         if not self.redis_client:
-            return None
+            return None, None
             
         try:
-            cached_data = self.redis_client.get(CACHE_KEY)
+            cached_data, stale_data = self._read_cache_sections()
             if cached_data:
                 logger.info("Cache hit - returning cached data")
-                return json.loads(cached_data)
             else:
                 logger.info("Cache miss - will fetch fresh data")
-                return None
+            return cached_data, stale_data
                 
         except Exception as e:
             logger.error(f"Error retrieving from Redis cache: {str(e)}")
-            return None
+            return None, None
     
     def _save_cached_data(self, market_data: Dict[str, Any]) -> bool:
         """
         SRE Fix #1: High-performance Redis cache storage
-        Saves data with TTL for automatic expiration
+        Saves data until invalidated, with a backstop TTL
         """
         if not self.redis_client:
             return False
             
         try:
-            json_data = json.dumps(market_data)
-            self.redis_client.setex(CACHE_KEY, CACHE_TTL_SECONDS, json_data)
+            # orjson emits bytes, which redis-py stores as-is
+            sections = {
+                key: orjson.dumps({field: market_data.get(field) for field in fields})
+                for key, fields in CACHE_SECTIONS.items()
+            }
+            
+            # MSET of fresh and stale copies plus backstop EXPIRE on the fresh
+            # ones, in a single round trip
+            pipe = self.redis_client.pipeline()
+            pipe.mset(sections)
+            pipe.mset({key + STALE_KEY_SUFFIX: value for key, value in sections.items()})
+            for key in sections:
+                pipe.expire(key, CACHE_TTL_SECONDS)
+            pipe.execute()
+            
             logger.info("Data cached successfully in Redis")
             return True
             
@@ -157,114 +259,111 @@ class MarketDataAPIHardened:
             logger.error(f"Error saving to Redis cache: {str(e)}")
             return False
     
-    def _get_stale_data(self) -> Optional[Dict[str, Any]]:
-        """
-        SRE Fix #2: Stale-while-revalidate fallback
-        Returns any cached data, even if expired, for resilience
-        """
+    def _is_servable_stale(self, stale_data: bytes) -> bool:
+        """True if stale data is recent enough to serve while revalidating"""
+        try:
+            saved_at = datetime.fromisoformat(orjson.loads(stale_data)["lastUpdated"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return (datetime.utcnow() - saved_at).total_seconds() < STALE_SERVE_SECONDS
+    
+    def _refresh_in_background(self) -> None:
+        """Schedule one cache refresh; the Redis lock stops concurrent requests piling on"""
+        try:
+            if not self.redis_client.set(REFRESH_LOCK_KEY, 1, nx=True, ex=REFRESH_LOCK_SECONDS):
+                return  # Another request is already refreshing
+        except Exception as e:
+            logger.error(f"Error acquiring refresh lock: {str(e)}")
+            return
+        
+        def refresh() -> None:
+            try:
+                fresh_data = self.fetch_fresh_data()
+                if fresh_data:
+                    self._save_cached_data(fresh_data)
+            finally:
+                try:
+                    self.redis_client.delete(REFRESH_LOCK_KEY)
+                except Exception as e:
+                    logger.error(f"Error releasing refresh lock: {str(e)}")
+        
+        _refresh_executor.submit(refresh)
+    
+    def _invalidate_cache(self) -> bool:
+        """Drop the fresh cache sections so the next read fetches fresh data (stale copies stay)"""
         if not self.redis_client:
-            return None
-            
+            return False
+        
         try:
-            # Try to get any data, even expired
-            cached_data = self.redis_client.get(CACHE_KEY)
-            if cached_data:
-                logger.info("Returning stale cached data for resilience")
-                return json.loads(cached_data)
-            return None
+            self.redis_client.delete(*CACHE_SECTIONS)
+            logger.info("Market data cache invalidated")
+            return True
             
         except Exception as e:
-            logger.error(f"Error retrieving stale data: {str(e)}")
-            return None
+            logger.error(f"Error invalidating Redis cache: {str(e)}")
+            return False
     
     @retry(
         stop=stop_after_attempt(2),
         wait=wait_exponential(multiplier=1, min=1, max=3)
     )
-    def _fetch_index_data(self, api_key: str) -> List[Dict[str, Any]]:
-        """SRE Fix #4: Fetch index data with explicit timeout"""
-        indices = []
-        
-        # NIFTY 50 (^NSEI)
+    def _fetch_single_quote(self, symbol: str, name: str, api_key: str) -> Optional[Dict[str, Any]]:
+        """SRE Fix #4: Fetch one index quote with explicit timeout"""
         try:
-            url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^NSEI&apikey={api_key}"
-            response = requests.get(url, timeout=10)  # SRE Fix #4: Explicit timeout
+            response = self.http.get(QUOTE_URL.format(symbol=symbol, api_key=api_key))  # SRE Fix #4: Explicit timeout
             response.raise_for_status()
             
             data = response.json()
             quote = data.get("Global Quote", {})
             
-            if quote and quote.get("05. price"):
-                price = float(quote.get("05. price", 0))
-                change = float(quote.get("09. change", 0))
-                change_percent = float(quote.get("10. change percent", "0%").replace("%", ""))
+            if quote and quote.get(QUOTE_PRICE):
+                price = float(quote.get(QUOTE_PRICE, 0))
+                change = float(quote.get(QUOTE_CHANGE, 0))
+                change_percent = float(quote.get(QUOTE_CHANGE_PERCENT, "0%").rstrip("%") or 0)
                 
-                indices.append({
-                    "name": "NIFTY 50",
+                return {
+                    "name": name,
                     "price": price,
                     "change": change,
                     "changePercent": change_percent
-                })
+                }
                 
-        except requests.Timeout:
-            logger.error("Timeout fetching NIFTY 50 data")
+        except httpx.TimeoutException:
+            logger.error(f"Timeout fetching {name} data")
         except Exception as e:
-            logger.error(f"Error fetching NIFTY 50 data: {str(e)}")
+            logger.error(f"Error fetching {name} data: {str(e)}")
         
-        # SENSEX (^BSESN)
+        return None
+    
+    def _fetch_market_movers(self, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
+        """SRE Fix #4: Fetch top gainers and losers in one call with explicit timeout"""
         try:
-            url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol=^BSESN&apikey={api_key}"
-            response = requests.get(url, timeout=10)  # SRE Fix #4: Explicit timeout
+            # TOP_GAINERS_LOSERS returns both lists at once instead of one quote per ticker
+            response = self.http.get(MOVERS_URL.format(api_key=api_key))  # SRE Fix #4: Explicit timeout
             response.raise_for_status()
             
             data = response.json()
-            quote = data.get("Global Quote", {})
+            return {
+                "gainers": [self._parse_mover(item) for item in data.get("top_gainers", [])[:MOVERS_LIMIT]],
+                "losers": [self._parse_mover(item) for item in data.get("top_losers", [])[:MOVERS_LIMIT]]
+            }
             
-            if quote and quote.get("05. price"):
-                price = float(quote.get("05. price", 0))
-                change = float(quote.get("09. change", 0))
-                change_percent = float(quote.get("10. change percent", "0%").replace("%", ""))
-                
-                indices.append({
-                    "name": "SENSEX",
-                    "price": price,
-                    "change": change,
-                    "changePercent": change_percent
-                })
-                
-        except requests.Timeout:
-            logger.error("Timeout fetching SENSEX data")
+        except httpx.TimeoutException:
+            logger.error("Timeout fetching market movers")
         except Exception as e:
-            logger.error(f"Error fetching SENSEX data: {str(e)}")
+            logger.error(f"Error fetching market movers: {str(e)}")
         
-        return indices
+        return {"gainers": [], "losers": []}
     
-    def _fetch_market_movers(self, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
-        """SRE Fix #4: Fetch market movers with timeout handling"""
-        try:
-            # Mock data for demonstration - replace with actual API calls
-            # In production, add proper timeout handling here too
-            gainers = [
-                {"ticker": "LT", "name": "Larsen & Toubro", "price": 3500.00, "changePercent": 5.2},
-                {"ticker": "M&M", "name": "Mahindra & Mahindra", "price": 2900.00, "changePercent": 4.8},
-                {"ticker": "RELIANCE", "name": "Reliance Industries", "price": 2450.00, "changePercent": 3.5},
-                {"ticker": "TCS", "name": "Tata Consultancy", "price": 3200.00, "changePercent": 2.8},
-                {"ticker": "HDFCBANK", "name": "HDFC Bank", "price": 1650.00, "changePercent": 2.1}
-            ]
-            
-            losers = [
-                {"ticker": "INFY", "name": "Infosys", "price": 1500.00, "changePercent": -1.8},
-                {"ticker": "WIPRO", "name": "Wipro", "price": 420.00, "changePercent": -1.5},
-                {"ticker": "ONGC", "name": "Oil & Natural Gas", "price": 245.00, "changePercent": -1.2},
-                {"ticker": "NTPC", "name": "NTPC", "price": 265.00, "changePercent": -0.9},
-                {"ticker": "COALINDIA", "name": "Coal India", "price": 385.00, "changePercent": -0.7}
-            ]
-            
-            return {"gainers": gainers, "losers": losers}
-            
-        except Exception as e:
-            logger.error(f"Error fetching market movers: {str(e)}")
-            return {"gainers": [], "losers": []}
+    @staticmethod
+    def _parse_mover(item: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert one TOP_GAINERS_LOSERS entry to the movers format"""
+        return {
+            "ticker": item["ticker"],
+            "name": item.get("name", item["ticker"]),
+            "price": float(item.get("price", 0)),
+            "changePercent": float(item.get("change_percentage", "0%").rstrip("%") or 0)
+        }
     
     def _fetch_sector_data(self, api_key: str) -> List[Dict[str, Any]]:
         """SRE Fix #4: Fetch sector data with timeout handling"""
@@ -299,10 +398,20 @@ class MarketDataAPIHardened:
             
             logger.info("Fetching fresh market data...")
             
-            # Fetch all data components with timeout handling
-            indices = self._fetch_index_data(api_key)
-            movers = self._fetch_market_movers(api_key)
-            sectors = self._fetch_sector_data(api_key)
+            # Fetch all data components with timeout handling - independent network calls run
+            # concurrently and share the pooled HTTP/2 connection
+            with ThreadPoolExecutor(max_workers=len(INDEX_SYMBOLS) + 2) as executor:
+                quote_futures = [
+                    executor.submit(self._fetch_single_quote, symbol, name, api_key)
+                    for symbol, name in INDEX_SYMBOLS
+                ]
+                movers_future = executor.submit(self._fetch_market_movers, api_key)
+                sectors_future = executor.submit(self._fetch_sector_data, api_key)
+                
+                # Keep index order stable regardless of completion order
+                indices = [quote for quote in (f.result() for f in quote_futures) if quote]
+                movers = movers_future.result()
+                sectors = sectors_future.result()
             
             # Aggregate data
             market_data = {
@@ -321,34 +430,42 @@ class MarketDataAPIHardened:
             logger.error(f"Error fetching fresh data: {str(e)}")
             return None
     
-    def get_market_data(self) -> Dict[str, Any]:
+    def get_market_data(self) -> Union[bytes, Dict[str, Any]]:
         """
         SRE Fix #1 & #2: Main method with Redis caching and stale-while-revalidate
+        Cache hits come back as serialized JSON bytes, everything else as a dict
         """
-        # Step 1: Try to get fresh cached data
-        cached_data = self._get_cached_data()
+        # Step 1: Try to get fresh cached data (the stale copy comes back in the same call)
+        cached_data, stale_data = self._get_cached_data()
         if cached_data:
             return cached_data
         
-        # Step 2: Cache miss - fetch fresh data
+        # Step 2: Stale-while-revalidate - recent stale data is returned right away
+        # and refreshed in the background, so clients don't wait on the upstream API
+        if stale_data and self._is_servable_stale(stale_data):
+            logger.info("Serving recent stale data while refreshing in background")
+            self._refresh_in_background()
+            return stale_data
+        
+        # Step 3: Cold start or stale data too old - fetch fresh data synchronously
         fresh_data = self.fetch_fresh_data()
         
         if fresh_data:
-            # Step 3: Save to cache and return fresh data
+            # Step 4: Save to cache and return fresh data
             self._save_cached_data(fresh_data)
             return fresh_data
         
-        # Step 4: SRE Fix #2 - Fresh data failed, try stale cache
+        # Step 5: SRE Fix #2 - Fresh data failed, try stale cache
         logger.warning("Fresh data fetch failed, attempting stale-while-revalidate")
-        stale_data = self._get_stale_data()
         
         if stale_data:
             logger.info("Returning stale data for resilience")
+            stale_data = orjson.loads(stale_data)
             stale_data["source"] = "stale_cache"
             stale_data["warning"] = "Data may be outdated"
             return stale_data
         
-        # Step 5: Complete failure - return service unavailable response
+        # Step 6: Complete failure - return service unavailable response
         logger.error("No data available - service unavailable")
         return {
             "error": "Market data is temporarily unavailable",
@@ -392,6 +509,40 @@ def require_app_check(f):
     return decorated_function
 
 
+def verify_scheduler_token(auth_header: Optional[str]) -> bool:
+    """
+    Verify the Google-signed OIDC token Cloud Scheduler sends as a Bearer token:
+    signature, audience and the invalidation service account's verified email.
+    Fails closed when INVALIDATE_SERVICE_ACCOUNT or INVALIDATE_AUDIENCE is unset
+    """
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return False
+    if not INVALIDATE_SERVICE_ACCOUNT or not INVALIDATE_AUDIENCE:
+        return False
+    
+    try:
+        claims = id_token.verify_oauth2_token(auth_header[len("Bearer "):], _google_auth_request,
+                                              audience=INVALIDATE_AUDIENCE)
+    except Exception as e:
+        logger.error(f"Scheduler token verification failed: {str(e)}")
+        return False
+    return claims.get("email") == INVALIDATE_SERVICE_ACCOUNT and bool(claims.get("email_verified"))
+
+
+def require_scheduler_identity(f):
+    """
+    Decorator for internal endpoints: only the invalidation service account may call them
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not verify_scheduler_token(request.headers.get('Authorization')):
+            logger.warning("Unauthorized internal request - missing or invalid OIDC token")
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 # Initialize the hardened API
 market_api = MarketDataAPIHardened()
 
@@ -406,6 +557,14 @@ def get_market_data():
         # Get market data with all SRE fixes applied
         data = market_api.get_market_data()
         
+        # Cache hits are already JSON - send them without a decode/encode round trip.
+        # The ETag lets repeat clients revalidate and get an empty 304 back
+        if isinstance(data, bytes):
+            response = Response(data, status=200, mimetype="application/json")
+            response.set_etag(hashlib.md5(data).hexdigest())
+            response.cache_control.no_cache = True  # Revalidate: invalidation can change data any minute
+            return response.make_conditional(request)
+        
         # Determine appropriate HTTP status code
         if "error" in data and data["error"] == "Market data is temporarily unavailable":
             return jsonify(data), 503  # Service Unavailable
@@ -419,6 +578,17 @@ def get_market_data():
         return jsonify({"error": "Internal server error"}), 500
 
 
+@app.route('/internal/invalidate', methods=['POST'])
+@require_scheduler_identity
+def invalidate_market_data():
+    """
+    Invalidate the market data cache; called by the scheduler / quote feed on updates
+    """
+    if market_api._invalidate_cache():
+        return jsonify({"status": "invalidated"}), 200
+    return jsonify({"error": "Cache unavailable"}), 503
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
@@ -438,12 +608,9 @@ def market_data_function_hardened(request):
     """
     SRE Fix #4: Hardened Cloud Function entry point with timeout configuration
     """
-    with app.test_request_context(
-        path=request.path,
-        method=request.method,
-        headers=request.headers,
-        data=request.get_data()
-    ):
+    # Dispatch on the incoming WSGI environ directly instead of rebuilding a
+    # test request (which re-parses headers and copies the body)
+    with app.request_context(request.environ):
         return app.full_dispatch_request()
 
 
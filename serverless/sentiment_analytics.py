@@ -1,20 +1,35 @@
 """
 AI Market Insights - Sentiment Analytics Engine
 Two scheduled functions for real-time sentiment gauge and daily analytics
+
+The count() aggregations filter sentiment by equality on a publishedAt range and
+need the composite indexes in firestore.indexes.json on `articles`:
+(sentiment, publishedAt) and, per sector, (tickers array-contains, sentiment,
+publishedAt) plus (tickers array-contains, publishedAt)
 """
 
-import json
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import chain
+from types import MappingProxyType
+from typing import Dict, List, Any, Optional, Tuple
 from collections import defaultdict
 
+import numpy as np
+import orjson
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud import functions_v2
+from google.cloud.firestore import AsyncClient
+
+from firestore_utils import run_with_async_client, snapshot_field
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (LOG_LEVEL=WARNING in production skips INFO record formatting)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Initialize Firebase
@@ -22,8 +37,17 @@ try:
     firebase_admin.get_app()
 except ValueError:
     firebase_admin.initialize_app()
+# global: Cloud Functions reuses this process across warm invocations, so the
+# client (and its gRPC channel) is created once per instance
 db = firestore.client()
 
+# Warm the gRPC channel at cold start so the first scheduled run doesn't pay
+# the TLS/HTTP2 handshake; a failure here is harmless and retried on first use
+try:
+    next(db.collection('articles').select([]).limit(1).stream(), None)
+except Exception as e:
+    logger.warning("Firestore warm-up failed: %s", e)
+
 # Ticker to Sector Mapping
 TICKER_TO_SECTOR = {
     # IT Sector
@@ -129,43 +153,75 @@ SECTORS = [
     "Energy", "Metals", "Real Estate", "Telecom", "Power"
 ]
 
+# Sentiment label -> score for the common spellings; other casings fall back to .lower()
+_CANONICAL_SENTIMENT_SCORES = {"positive": 1, "negative": -1, "neutral": 0}
+_SENTIMENT_SCORES = {
+    variant: score
+    for label, score in _CANONICAL_SENTIMENT_SCORES.items()
+    for variant in (label, label.capitalize(), label.upper())
+}
+
+# Read-only template for empty/error records; copy with dict() before use
+EMPTY_SECTOR_BREAKDOWN = MappingProxyType({sector: 0.0 for sector in SECTORS})
+
+# Daily results kept per date so Cloud Scheduler retries don't re-aggregate the day
+DAILY_CACHE_TTL = 300
+_daily_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+# Rolling window of the real-time gauge
+REAL_TIME_WINDOW = timedelta(hours=6)
+REAL_TIME_WINDOW_LABEL = "6 hours"
+
+# Inverted mapping for per-sector array-contains-any queries (max 30 values each)
+TICKERS_BY_SECTOR = defaultdict(list)
+for _ticker, _sector in TICKER_TO_SECTOR.items():
+    TICKERS_BY_SECTOR[_sector].append(_ticker)
+
+# Ticker -> row in SECTORS, for np.bincount aggregation
+TICKER_SECTOR_INDEX = {ticker: SECTORS.index(sector) for ticker, sector in TICKER_TO_SECTOR.items()}
+
+
+def _sentiment_score(sentiment: Any) -> int:
+    """Sentiment label -> score (neutral or unknown -> 0); lowercases only on a table miss"""
+    score = _SENTIMENT_SCORES.get(sentiment)
+    if score is None:
+        score = _CANONICAL_SENTIMENT_SCORES.get(str(sentiment).lower(), 0)
+    return score
+
 
 class SentimentAnalytics:
     """Main class for sentiment analytics calculations"""
     
+    # Firestore caps a WriteBatch at 500 operations
+    WRITE_BATCH_SIZE = 500
+    # The fallback day scan is split into this many time slices, fetched concurrently
+    SCAN_PARTITIONS = 8
+    # Documents per page of a scan slice (bounds the fallback's peak memory)
+    SCAN_PAGE_SIZE = 500
+    # Dates calculated concurrently by a backfill
+    BACKFILL_CONCURRENCY = 8
+    
     def __init__(self):
         self.db = db
     
-    def _sentiment_to_score(self, sentiment: str) -> int:
-        """Convert sentiment string to numerical score"""
-        sentiment_lower = sentiment.lower()
-        if sentiment_lower == "positive":
-            return 1
-        elif sentiment_lower == "negative":
-            return -1
-        else:  # neutral or unknown
-            return 0
-    
-    def _get_articles_in_timeframe(self, start_time: datetime, end_time: datetime) -> List[Dict[str, Any]]:
-        """Query articles within a specific timeframe"""
-        try:
-            articles_ref = self.db.collection('articles')
-            query = articles_ref.where('publishedAt', '>=', start_time).where('publishedAt', '<=', end_time)
-            
-            docs = query.stream()
-            articles = []
-            
-            for doc in docs:
-                article_data = doc.to_dict()
-                article_data['id'] = doc.id
-                articles.append(article_data)
-            
-            logger.info(f"Retrieved {len(articles)} articles from {start_time} to {end_time}")
-            return articles
-            
-        except Exception as e:
-            logger.error(f"Error querying articles: {str(e)}")
-            return []
+    def _aggregate_sentiment_in_timeframe(self, start_time: datetime, end_time: datetime) -> Dict[str, int]:
+        """
+        Count positive, negative and total articles in a timeframe with Firestore
+        count() aggregation queries - three small RPCs instead of reading every article
+        """
+        base = (self.db.collection('articles')
+                .where('publishedAt', '>=', start_time)
+                .where('publishedAt', '<=', end_time))
+        
+        counts = {}
+        for key, query in (('pos', base.where('sentiment', '==', 'Positive')),
+                           ('neg', base.where('sentiment', '==', 'Negative')),
+                           ('total', base)):
+            results = query.count(alias=key).get()
+            counts[key] = int(results[0][0].value)
+        
+        logger.info("Aggregated %s articles from %s to %s", counts['total'], start_time, end_time)
+        return counts
     
     def calculate_real_time_sentiment(self) -> Dict[str, Any]:
         """
@@ -177,124 +233,280 @@ class SentimentAnalytics:
             
             # Calculate 6-hour rolling window
             end_time = datetime.utcnow()
-            start_time = end_time - timedelta(hours=6)
+            start_time = end_time - REAL_TIME_WINDOW
+            
+            # Heartbeat: two limit(1) probes; if nothing entered or left the window
+            # since the last run, the stored average still holds
+            newest_ts = self._newest_article_ts(end_time)
+            previous = self._unchanged_real_time_sentiment(newest_ts, start_time)
+            if previous is not None:
+                logger.info("No articles entered or left the window, keeping the stored sentiment")
+                return {**previous, "lastUpdated": firestore.SERVER_TIMESTAMP, "windowStart": start_time}
             
-            # Query articles in the timeframe
-            articles = self._get_articles_in_timeframe(start_time, end_time)
+            # Server-side counts: score = (positive - negative) / total
+            counts = self._aggregate_sentiment_in_timeframe(start_time, end_time)
+            article_count = counts['total']
             
-            if not articles:
+            if article_count == 0:
                 logger.warning("No articles found in 6-hour window, defaulting to neutral")
                 return {
                     "averageScore": 0.0,
                     "lastUpdated": firestore.SERVER_TIMESTAMP,
                     "articlesAnalyzed": 0,
-                    "timeWindow": "6 hours"
+                    "timeWindow": REAL_TIME_WINDOW_LABEL,
+                    "lastArticleTs": newest_ts,
+                    "windowStart": start_time
                 }
             
-            # Calculate sentiment scores
-            sentiment_scores = []
-            for article in articles:
-                sentiment = article.get('sentiment', 'Neutral')
-                score = self._sentiment_to_score(sentiment)
-                sentiment_scores.append(score)
-            
-            # Calculate average
-            average_score = sum(sentiment_scores) / len(sentiment_scores)
+            # Calculate average (neutral articles score 0)
+            average_score = (counts['pos'] - counts['neg']) / article_count
             
             result = {
                 "averageScore": round(average_score, 3),
                 "lastUpdated": firestore.SERVER_TIMESTAMP,
-                "articlesAnalyzed": len(articles),
-                "timeWindow": "6 hours"
+                "articlesAnalyzed": article_count,
+                "timeWindow": REAL_TIME_WINDOW_LABEL,
+                "lastArticleTs": newest_ts,
+                "windowStart": start_time
             }
             
-            logger.info(f"Real-time sentiment calculated: {average_score:.3f} from {len(articles)} articles")
+            logger.info("Real-time sentiment calculated: %.3f from %s articles", average_score, article_count)
             return result
             
         except Exception as e:
-            logger.error(f"Error calculating real-time sentiment: {str(e)}")
+            logger.error("Error calculating real-time sentiment: %s", e)
             return {
                 "averageScore": 0.0,
                 "lastUpdated": firestore.SERVER_TIMESTAMP,
                 "articlesAnalyzed": 0,
-                "timeWindow": "6 hours",
+                "timeWindow": REAL_TIME_WINDOW_LABEL,
                 "error": str(e)
             }
     
-    def calculate_daily_analytics(self, target_date: str = None) -> Dict[str, Any]:
+    def _newest_article_ts(self, end_time: datetime) -> Optional[datetime]:
+        """
+        publishedAt of the newest article up to end_time (a server timestamp, so it
+        only moves forward); bounded like the counts so a later article stays "new"
+        """
+        docs = (self.db.collection('articles')
+                .where('publishedAt', '<=', end_time)
+                .order_by('publishedAt', direction=firestore.Query.DESCENDING)
+                .select(['publishedAt'])
+                .limit(1)
+                .get())
+        return docs[0].get('publishedAt') if docs else None
+    
+    def _unchanged_real_time_sentiment(self, newest_ts: Optional[datetime],
+                                       start_time: datetime) -> Optional[Dict[str, Any]]:
+        """
+        The stored gauge document if its window still holds the same articles:
+        no article newer than its lastArticleTs and none published between its
+        windowStart and the new start_time; None means recompute
+        """
+        snapshot = self.db.collection('market_status').document('current_sentiment').get()
+        previous = snapshot.to_dict() if snapshot.exists else None
+        if (not previous or 'error' in previous or newest_ts is None
+                or previous.get('lastArticleTs') is None or previous.get('windowStart') is None):
+            return None
+        if newest_ts > previous['lastArticleTs']:
+            return None
+        expired = (self.db.collection('articles')
+                   .where('publishedAt', '>=', previous['windowStart'])
+                   .where('publishedAt', '<', start_time)
+                   .select([])
+                   .limit(1)
+                   .get())
+        return None if expired else previous
+    
+    async def _aggregate_daily_server_side(self, async_db: AsyncClient, start_time: datetime, end_time: datetime
+                                           ) -> Tuple[Tuple[int, int], Dict[str, Tuple[int, int]]]:
+        """
+        Day and per-sector (score sum, article count) from count() aggregation queries
+        Positive/negative/total counts for the day and for each sector's tickers
+        (array-contains-any) run concurrently, so wall time is the slowest query.
+        Requires a composite index on (tickers array-contains, sentiment, publishedAt)
+        """
+        base = (async_db.collection('articles')
+                .where('publishedAt', '>=', start_time)
+                .where('publishedAt', '<=', end_time))
+        sector_scopes = [base.where('tickers', 'array_contains_any', TICKERS_BY_SECTOR[sector])
+                         for sector in SECTORS]
+        
+        async def count(query) -> int:
+            results = await query.count(alias='count').get()
+            return int(results[0][0].value)
+        
+        async def score(scope) -> Tuple[int, int]:
+            pos, neg, total = await asyncio.gather(count(scope.where('sentiment', '==', 'Positive')),
+                                                   count(scope.where('sentiment', '==', 'Negative')),
+                                                   count(scope))
+            return pos - neg, total
+        
+        overall, *per_sector = await asyncio.gather(score(base), *(score(scope) for scope in sector_scopes))
+        return overall, dict(zip(SECTORS, per_sector))
+    
+    def _fold_page(self, docs: List[Any]) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        """(score sum, article count, per-sector sums, per-sector counts) for one page of snapshots"""
+        article_count = len(docs)
+        
+        # Scores as one array, one table lookup per article
+        scores = np.fromiter((_sentiment_score(snapshot_field(doc, 'sentiment')) for doc in docs),
+                             dtype=np.int64, count=article_count)
+        
+        # Distinct sector ids per article in CSR layout: per-article counts plus one
+        # flat id array, so each pair gets its article's score via np.repeat. An
+        # article counts once per sector however many of its tickers map there,
+        # matching the array-contains-any count() queries
+        get_index = TICKER_SECTOR_INDEX.get
+        article_sectors = [{get_index(ticker) for ticker in snapshot_field(doc, 'tickers') or ()} - {None}
+                           for doc in docs]
+        pair_counts = np.fromiter(map(len, article_sectors), dtype=np.intp, count=article_count)
+        sector_ids = np.fromiter(chain.from_iterable(article_sectors), dtype=np.intp,
+                                 count=int(pair_counts.sum()))
+        
+        sector_sums = np.bincount(sector_ids, weights=np.repeat(scores, pair_counts), minlength=len(SECTORS))
+        sector_counts = np.bincount(sector_ids, minlength=len(SECTORS))
+        return int(scores.sum()), article_count, sector_sums, sector_counts
+    
+    def _scan_slice(self, start_time: datetime, end_time: datetime, end_op: str
+                    ) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        """
+        Fold one publishedAt slice page by page (SCAN_PAGE_SIZE docs, cursor on the
+        last snapshot), so only one page of a large day is held in memory at a time
+        """
+        # publishedAt is projected because the start_after cursor reads it from the snapshot
+        query = (self.db.collection('articles')
+                 .where('publishedAt', '>=', start_time)
+                 .where('publishedAt', end_op, end_time)
+                 .select(['sentiment', 'tickers', 'publishedAt'])
+                 .order_by('publishedAt')
+                 .limit(self.SCAN_PAGE_SIZE))
+        
+        score_sum = article_count = 0
+        sector_sums = np.zeros(len(SECTORS))
+        sector_counts = np.zeros(len(SECTORS), dtype=np.intp)
+        last = None
+        while True:
+            page = list((query.start_after(last) if last else query).stream())
+            if not page:
+                break
+            page_sum, page_count, page_sector_sums, page_sector_counts = self._fold_page(page)
+            score_sum += page_sum
+            article_count += page_count
+            sector_sums += page_sector_sums
+            sector_counts += page_sector_counts
+            if len(page) < self.SCAN_PAGE_SIZE:
+                break
+            last = page[-1]
+        return score_sum, article_count, sector_sums, sector_counts
+    
+    def _aggregate_daily_by_scan(self, start_time: datetime, end_time: datetime
+                                 ) -> Tuple[Tuple[int, int], Dict[str, Tuple[int, int]]]:
+        """
+        Day and per-sector (score sum, article count) from reading every article.
+        The range is split into SCAN_PARTITIONS slices folded in parallel so their
+        round trips overlap; slicing on publishedAt needs no composite index, and
+        errors propagate instead of returning a partial day
+        """
+        step = (end_time - start_time) / self.SCAN_PARTITIONS
+        bounds = [start_time + step * i for i in range(self.SCAN_PARTITIONS)] + [end_time]
+        
+        def scan(i: int) -> Tuple[int, int, np.ndarray, np.ndarray]:
+            # Half-open slices; the last one keeps the inclusive end bound
+            end_op = '<=' if i == self.SCAN_PARTITIONS - 1 else '<'
+            return self._scan_slice(bounds[i], bounds[i + 1], end_op)
+        
+        overall_sum = article_count = 0
+        sector_sums = np.zeros(len(SECTORS))
+        sector_counts = np.zeros(len(SECTORS), dtype=np.intp)
+        for slice_sum, slice_count, slice_sector_sums, slice_sector_counts in _scan_pool.map(
+                scan, range(self.SCAN_PARTITIONS)):
+            overall_sum += slice_sum
+            article_count += slice_count
+            sector_sums += slice_sector_sums
+            sector_counts += slice_sector_counts
+        
+        logger.info("Scanned %s articles from %s to %s", article_count, start_time, end_time)
+        return (overall_sum, article_count), {
+            sector: (int(sector_sums[i]), int(sector_counts[i])) for i, sector in enumerate(SECTORS)
+        }
+    
+    def calculate_daily_analytics(self, target_date: str = None, refresh: bool = False) -> Dict[str, Any]:
         """
         Function 2: Calculate daily analytics for historical charts
-        Returns comprehensive daily sentiment breakdown
+        Returns comprehensive daily sentiment breakdown; a result for the same date
+        computed within DAILY_CACHE_TTL is reused unless refresh is set
+        """
+        date_str = target_date or datetime.utcnow().strftime("%Y-%m-%d")
+        now = time.monotonic()
+        cached = _daily_cache.get(date_str)
+        if cached and not refresh and now - cached[0] < DAILY_CACHE_TTL:
+            logger.info("Reusing daily analytics for %s computed %.0fs ago", date_str, now - cached[0])
+            return dict(cached[1])
+        
+        result = run_with_async_client(lambda async_db: self.calculate_daily_analytics_async(date_str, async_db))
+        # Errors are not cached so a retry recalculates
+        if 'error' not in result:
+            _daily_cache[date_str] = (now, result)
+        return dict(result)
+    
+    async def calculate_daily_analytics_async(self, target_date: Optional[str],
+                                              async_db: AsyncClient) -> Dict[str, Any]:
+        """
+        calculate_daily_analytics as a coroutine, so a backfill can overlap several
+        dates on the shared AsyncClient; the blocking fallback scan runs in a thread
         """
+        # Resolved once, before the try, so the error path reuses them
+        now = datetime.utcnow()
+        date_str = target_date or now.strftime("%Y-%m-%d")
         try:
-            logger.info(f"Starting daily analytics calculation for {target_date or 'today'}...")
-            
-            # Determine target date
-            if target_date:
-                target_datetime = datetime.strptime(target_date, "%Y-%m-%d")
-            else:
-                target_datetime = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            logger.info("Starting daily analytics calculation for %s...", date_str)
             
-            # Calculate day boundaries
-            start_time = target_datetime
+            # Calculate day boundaries (date.fromisoformat only accepts dates, like the old strptime)
+            start_time = datetime.combine(date.fromisoformat(date_str), datetime.min.time())
             end_time = start_time + timedelta(days=1)
             
-            # Query articles for the entire day
-            articles = self._get_articles_in_timeframe(start_time, end_time)
+            # Server-side aggregation, then a full read (e.g. index still building)
+            try:
+                totals = await self._aggregate_daily_server_side(async_db, start_time, end_time)
+                (overall_sum, article_count), sector_totals = totals
+            except Exception as e:
+                logger.warning("Aggregation query failed (%s), falling back to article scan", e)
+                (overall_sum, article_count), sector_totals = await asyncio.to_thread(
+                    self._aggregate_daily_by_scan, start_time, end_time)
             
-            if not articles:
-                logger.warning(f"No articles found for {target_date}, creating empty record")
-                return self._create_empty_daily_record(target_date or target_datetime.strftime("%Y-%m-%d"))
-            
-            # Initialize sector tracking
-            sector_scores = defaultdict(list)
-            overall_scores = []
-            
-            # Process each article
-            for article in articles:
-                sentiment = article.get('sentiment', 'Neutral')
-                score = self._sentiment_to_score(sentiment)
-                overall_scores.append(score)
-                
-                # Process tickers for sector analysis
-                tickers = article.get('tickers', [])
-                for ticker in tickers:
-                    ticker_upper = ticker.upper()
-                    if ticker_upper in TICKER_TO_SECTOR:
-                        sector = TICKER_TO_SECTOR[ticker_upper]
-                        sector_scores[sector].append(score)
+            if article_count == 0:
+                logger.warning("No articles found for %s, creating empty record", date_str)
+                return self._create_empty_daily_record(date_str)
             
             # Calculate overall sentiment
-            overall_sentiment = sum(overall_scores) / len(overall_scores) if overall_scores else 0.0
+            overall_sentiment = overall_sum / article_count
             
             # Calculate sector breakdown
             sector_breakdown = {}
             for sector in SECTORS:
-                if sector in sector_scores and sector_scores[sector]:
-                    sector_avg = sum(sector_scores[sector]) / len(sector_scores[sector])
-                    sector_breakdown[sector] = round(sector_avg, 3)
-                else:
-                    sector_breakdown[sector] = 0.0
+                sector_sum, sector_count = sector_totals[sector]
+                sector_breakdown[sector] = round(sector_sum / sector_count, 3) if sector_count else 0.0
             
             result = {
-                "date": target_date or target_datetime.strftime("%Y-%m-%d"),
+                "date": date_str,
                 "overallSentimentScore": round(overall_sentiment, 3),
-                "articlesAnalyzed": len(articles),
+                "articlesAnalyzed": article_count,
                 "sectorBreakdown": sector_breakdown,
                 "lastUpdated": firestore.SERVER_TIMESTAMP,
-                "processingTime": datetime.utcnow().isoformat()
+                "processingTime": now.isoformat()
             }
             
-            logger.info(f"Daily analytics calculated: {overall_sentiment:.3f} from {len(articles)} articles")
+            logger.info("Daily analytics calculated: %.3f from %s articles", overall_sentiment, article_count)
             return result
             
         except Exception as e:
-            logger.error(f"Error calculating daily analytics: {str(e)}")
+            logger.error("Error calculating daily analytics: %s", e)
             return {
-                "date": target_date or datetime.utcnow().strftime("%Y-%m-%d"),
+                "date": date_str,
                 "overallSentimentScore": 0.0,
                 "articlesAnalyzed": 0,
-                "sectorBreakdown": {sector: 0.0 for sector in SECTORS},
+                "sectorBreakdown": dict(EMPTY_SECTOR_BREAKDOWN),
                 "lastUpdated": firestore.SERVER_TIMESTAMP,
                 "error": str(e)
             }
@@ -305,7 +517,7 @@ class SentimentAnalytics:
             "date": date,
             "overallSentimentScore": 0.0,
             "articlesAnalyzed": 0,
-            "sectorBreakdown": {sector: 0.0 for sector in SECTORS},
+            "sectorBreakdown": dict(EMPTY_SECTOR_BREAKDOWN),
             "lastUpdated": firestore.SERVER_TIMESTAMP,
             "note": "No articles found for this date"
         }
@@ -320,7 +532,7 @@ class SentimentAnalytics:
             return True
             
         except Exception as e:
-            logger.error(f"Error saving real-time sentiment: {str(e)}")
+            logger.error("Error saving real-time sentiment: %s", e)
             return False
     
     def save_daily_analytics(self, analytics_data: Dict[str, Any]) -> bool:
@@ -330,18 +542,89 @@ class SentimentAnalytics:
             doc_ref = self.db.collection('sentiment_history').document(date)
             doc_ref.set(analytics_data)
             
-            logger.info(f"Daily analytics saved to sentiment_history/{date}")
+            logger.info("Daily analytics saved to sentiment_history/%s", date)
             return True
             
         except Exception as e:
-            logger.error(f"Error saving daily analytics: {str(e)}")
+            logger.error("Error saving daily analytics: %s", e)
             return False
+    
+    def save_daily_analytics_batch(self, records: List[Dict[str, Any]]) -> int:
+        """
+        Save many daily analytics records (backfill / repair) with one WriteBatch
+        commit per WRITE_BATCH_SIZE records; returns the number saved
+        """
+        saved = 0
+        history_ref = self.db.collection('sentiment_history')
+        
+        for i in range(0, len(records), self.WRITE_BATCH_SIZE):
+            chunk = records[i:i + self.WRITE_BATCH_SIZE]
+            try:
+                batch = self.db.batch()
+                for record in chunk:
+                    batch.set(history_ref.document(record['date']), record)
+                batch.commit()
+                saved += len(chunk)
+            except Exception as e:
+                logger.error("Error saving daily analytics batch: %s", e)
+        
+        logger.info("Saved %s/%s daily analytics records to sentiment_history", saved, len(records))
+        return saved
+    
+    async def _calculate_dates_async(self, dates: List[str], async_db: AsyncClient) -> List[Dict[str, Any]]:
+        """Daily analytics for each date, at most BACKFILL_CONCURRENCY dates in flight on one AsyncClient"""
+        semaphore = asyncio.Semaphore(self.BACKFILL_CONCURRENCY)
+        
+        async def one(date_str: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.calculate_daily_analytics_async(date_str, async_db)
+        
+        return await asyncio.gather(*(one(date_str) for date_str in dates))
+    
+    def backfill_daily_analytics(self, start_date: str, end_date: str) -> Tuple[int, List[str]]:
+        """
+        Recalculate daily analytics for every date in [start_date, end_date] and save
+        them in batches; returns (records saved, dates whose calculation failed).
+        Failed dates are not saved, so their existing history is left untouched
+        """
+        current = datetime.strptime(start_date, "%Y-%m-%d")
+        last = datetime.strptime(end_date, "%Y-%m-%d")
+        dates = []
+        while current <= last:
+            dates.append(current.strftime("%Y-%m-%d"))
+            current += timedelta(days=1)
+        records = run_with_async_client(lambda async_db: self._calculate_dates_async(dates, async_db))
+        # Recalculated dates supersede anything the scheduled engine cached
+        for date_str in dates:
+            _daily_cache.pop(date_str, None)
+        
+        failed = [record['date'] for record in records if 'error' in record]
+        if failed:
+            logger.warning("Backfill skipped %s dates that failed to calculate: %s", len(failed), failed)
+        saved = self.save_daily_analytics_batch([record for record in records if 'error' not in record])
+        return saved, failed
+
 
+# global: scan worker threads are reused across warm invocations
+_scan_pool = ThreadPoolExecutor(max_workers=SentimentAnalytics.SCAN_PARTITIONS)
 
 # Initialize analytics engine
 analytics = SentimentAnalytics()
 
 
+def _to_json(payload: Dict[str, Any]) -> str:
+    """
+    orjson response body; the SERVER_TIMESTAMP sentinel (not serializable) becomes
+    the current time, and Firestore datetimes fall back to str()
+    """
+    now = datetime.utcnow().isoformat()
+    
+    def default(value: Any) -> str:
+        return now if value is firestore.SERVER_TIMESTAMP else str(value)
+    
+    return orjson.dumps(payload, default=default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
 def real_time_sentiment_gauge(request):
     """
     Cloud Function 1: Real-time Sentiment Gauge Engine
@@ -360,7 +643,7 @@ def real_time_sentiment_gauge(request):
             logger.info("Real-time sentiment gauge updated successfully")
             return {
                 'statusCode': 200,
-                'body': json.dumps({
+                'body': _to_json({
                     'message': 'Real-time sentiment updated',
                     'data': sentiment_data
                 })
@@ -369,27 +652,28 @@ def real_time_sentiment_gauge(request):
             logger.error("Failed to save real-time sentiment")
             return {
                 'statusCode': 500,
-                'body': json.dumps({'error': 'Failed to save sentiment data'})
+                'body': _to_json({'error': 'Failed to save sentiment data'})
             }
             
     except Exception as e:
-        logger.error(f"Error in real-time sentiment gauge: {str(e)}")
+        logger.error("Error in real-time sentiment gauge: %s", e)
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': _to_json({'error': str(e)})
         }
 
 
 def daily_analytics_engine(request):
     """
     Cloud Function 2: Daily Analytics Engine
-    Triggered daily at 11:55 PM
+    Triggered daily at 11:55 PM; ?refresh=true bypasses the per-date result cache
     """
     logger.info("Starting daily analytics calculation...")
     
     try:
         # Calculate daily analytics
-        analytics_data = analytics.calculate_daily_analytics()
+        refresh = request.args.get('refresh', '').lower() in ('1', 'true')
+        analytics_data = analytics.calculate_daily_analytics(refresh=refresh)
         
         # Save to Firestore
         success = analytics.save_daily_analytics(analytics_data)
@@ -398,7 +682,7 @@ def daily_analytics_engine(request):
             logger.info("Daily analytics updated successfully")
             return {
                 'statusCode': 200,
-                'body': json.dumps({
+                'body': _to_json({
                     'message': 'Daily analytics updated',
                     'data': analytics_data
                 })
@@ -407,14 +691,56 @@ def daily_analytics_engine(request):
             logger.error("Failed to save daily analytics")
             return {
                 'statusCode': 500,
-                'body': json.dumps({'error': 'Failed to save analytics data'})
+                'body': _to_json({'error': 'Failed to save analytics data'})
             }
             
     except Exception as e:
-        logger.error(f"Error in daily analytics engine: {str(e)}")
+        logger.error("Error in daily analytics engine: %s", e)
+        return {
+            'statusCode': 500,
+            'body': _to_json({'error': str(e)})
+        }
+
+
+def backfill_range(request):
+    """
+    Cloud Function 3: Backfill / repair daily analytics for a date range
+    Body or query string: start_date, end_date (YYYY-MM-DD, inclusive)
+    """
+    params = request.get_json(silent=True) or request.args
+    start_date = params.get('start_date')
+    end_date = params.get('end_date', start_date)
+    try:
+        if not start_date:
+            raise ValueError("start_date is required")
+        if datetime.strptime(start_date, "%Y-%m-%d") > datetime.strptime(end_date, "%Y-%m-%d"):
+            raise ValueError("start_date is after end_date")
+    except (TypeError, ValueError) as e:
+        return {
+            'statusCode': 400,
+            'body': _to_json({'error': f"Invalid date range: {str(e)}"})
+        }
+    
+    logger.info("Starting daily analytics backfill from %s to %s...", start_date, end_date)
+    
+    try:
+        saved, failed = analytics.backfill_daily_analytics(start_date, end_date)
+        
+        logger.info("Backfill saved %s daily analytics records", saved)
+        return {
+            'statusCode': 200,
+            'body': _to_json({
+                'message': 'Daily analytics backfilled',
+                'saved': saved,
+                'failed': failed
+            })
+        }
+        
+    except Exception as e:
+        logger.error("Error in daily analytics backfill: %s", e)
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': _to_json({'error': str(e)})
         }
 
 